@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for neuralnetworks_rs.
+
+Measures how fast the training step and inference are across batch sizes,
+how much memory they allocate, and checks that the faster code paths give the
+same answers as the annotated reference functions. Uses random MNIST-shaped
+data, so no download is needed.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --output new.json --compare results.json
+"""
+
+#used for extra math components
+import numpy as np
+
+#used to read the command line and write our results
+import argparse
+import json
+import platform
+import sys
+
+#used to time our functions and measure memory
+import time
+import tracemalloc
+
+#resource only exists on unix-like systems, and tells us the peak memory use
+# of our process.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import neuralnetworks_rs as nn
+
+#creates random data the same shape as MNIST: m columns of 784 raw pixels
+# (whole numbers from 0 to 255) and m labels from 0 to 9. Each digit gets its
+# own random pattern plus some noise, so there is something to learn.
+def synthetic_mnist(m, seed=0):
+    rng = np.random.default_rng(seed)
+    Y = rng.integers(0, 10, m)
+    patterns = rng.random((10, nn.WIDTH*nn.HEIGHT)) < 0.15
+    noise = rng.random((nn.WIDTH*nn.HEIGHT, m))
+    X = np.where(patterns[Y].T, noise * 255, (noise < 0.03) * 255)
+    return X.astype(np.uint8), Y
+
+#peak memory used by this process so far, in bytes (None if we can't tell).
+# ru_maxrss is in kilobytes on linux and in bytes on macOS.
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+#runs fn once to warm up, then repeats times, and returns the fastest and
+# median time in seconds along with the most memory allocated by a single run
+# (see benchmark_step_allocations in neuralnetworks_rs).
+def measure(fn, repeats):
+    fn()
+    seconds = []
+    allocated = []
+    tracemalloc.start()
+    for _ in range(repeats):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {"min_seconds": min(seconds),
+            "median_seconds": float(np.median(seconds)),
+            "alloc_bytes": max(allocated)}
+
+#one training step with the annotated two layer functions.
+def reference_step(X, Y, params, alpha):
+    W1, b1, W2, b2 = params
+    Z1, A1, Z2, A2 = nn.for_prop(X, W1, b1, W2, b2)
+    dW1, db1, dW2, db2 = nn.back_prop(X, Y, A1, A2, W2, Z1, Y.size)
+    return list(nn.update_wb(alpha, W1, b1, W2, b2, dW1, db1, dW2, db2))
+
+#one training step with the annotated N layer functions.
+def reference_layers_step(X, Y, params, alpha):
+    Zs, As = nn.for_prop_layers(X, params)
+    grads = nn.back_prop_layers(X, Y, Zs, As, params, Y.size)
+    return nn.update_layers(alpha, params, grads)
+
+#training step latency, samples per second and allocations for the reference
+# functions and the TrainingEngine, for every batch size.
+def bench_training(X, Y, batch_sizes, hidden, dtype, repeats, alpha=0.15):
+    results = {}
+    sizes = [X.shape[0], *hidden, 10]
+    for batch_size in batch_sizes:
+        X_batch = nn.scale_input(X[:, :batch_size], dtype)
+        Y_batch = Y[:batch_size]
+        np.random.seed(0)
+        params = nn.initial_layers(sizes, dtype)
+
+        #the reference keeps its own copy, since it updates in place too.
+        reference = [p.copy() for p in params]
+        results[f"train_step/reference/{batch_size}"] = measure(
+            lambda: reference_layers_step(X_batch, Y_batch, reference, alpha),
+            repeats)
+
+        engine = nn.TrainingEngine(params)
+        results[f"train_step/engine/{batch_size}"] = measure(
+            lambda: engine.step(X_batch, Y_batch, alpha), repeats)
+
+    for name, result in results.items():
+        batch_size = int(name.rsplit("/", 1)[1])
+        result["samples_per_second"] = batch_size / result["min_seconds"]
+    return results
+
+#inference latency, samples per second and allocations for make_predictions
+# as it used to be (for_prop_layers and argmax), the Predictor and the
+# QuantizedPredictor.
+def bench_inference(X, batch_sizes, hidden, dtype, repeats):
+    results = {}
+    np.random.seed(0)
+    params = nn.initial_layers([X.shape[0], *hidden, 10], dtype)
+    predictor = nn.Predictor(params)
+    quantized = nn.QuantizedPredictor(params)
+
+    def reference_predict(X_batch):
+        _, As = nn.for_prop_layers(nn.scale_input(X_batch, dtype), params)
+        return nn.predictions(As[-1])
+
+    for batch_size in batch_sizes:
+        X_batch = X[:, :batch_size]
+        results[f"inference/reference/{batch_size}"] = measure(
+            lambda: reference_predict(X_batch), repeats)
+        results[f"inference/predictor/{batch_size}"] = measure(
+            lambda: predictor.predict(X_batch), repeats)
+        results[f"inference/quantized/{batch_size}"] = measure(
+            lambda: quantized.predict(X_batch), repeats)
+
+    for name, result in results.items():
+        batch_size = int(name.rsplit("/", 1)[1])
+        result["samples_per_second"] = batch_size / result["min_seconds"]
+    return results
+
+#end to end train_model throughput, in samples per second of training data.
+def bench_train_model(X, Y, hidden, dtype, batch_size, iterations):
+    np.random.seed(0)
+    start = time.perf_counter()
+    nn.train_model(X, Y, 0.15, iterations, batch_size=batch_size, dtype=dtype,
+                   hidden=hidden)
+    seconds = time.perf_counter() - start
+    return {"train_model": {"seconds": seconds,
+                            "samples_per_second": Y.size*iterations/seconds}}
+
+#train_model with augmentation (see AUGMENTATION in neuralnetworks_rs): how
+# many images a second augment_images makes on its own, and how much of the
+# training time was spent waiting for augmented batches. With enough threads
+# (and processor cores) the batches are ready before they are needed, and the
+# waiting is close to 0.
+def bench_augmentation(X, Y, hidden, dtype, batch_size, iterations, workers):
+    rng = np.random.default_rng(0)
+    augment = nn.Augmenter()
+    result = measure(lambda: augment(X[:, :batch_size], rng), 3)
+    images_per_second = batch_size / result["min_seconds"]
+
+    recorder = nn.MetricsRecorder()
+    np.random.seed(0)
+    start = time.perf_counter()
+    nn.train_model(X, Y, 0.15, iterations, batch_size=batch_size, dtype=dtype,
+                   hidden=hidden, augment=augment, augment_workers=workers,
+                   callbacks=[recorder])
+    seconds = time.perf_counter() - start
+    waited = recorder.summary().get("augment", {"seconds": 0.0})["seconds"]
+    return {"train_model/augmented": {
+        "seconds": seconds, "samples_per_second": Y.size*iterations/seconds,
+        "augment_images_per_second": images_per_second,
+        "augment_workers": workers, "seconds_waiting": waited,
+        "fraction_waiting": waited / seconds}}
+
+#how much time early stopping saves (see VALIDATION in neuralnetworks_rs):
+# train_model for a fixed number of iterations, then again from the same start
+# stopping once the validation accuracy hasn't improved for patience checks.
+def bench_early_stopping(X, Y, hidden, dtype, batch_size, iterations, patience,
+                         validation=2000):
+    train, held_out = nn.split_validation(X, Y, validation)
+    results = {}
+    for name, wait in (("fixed", None), ("early_stopping", patience)):
+        recorder = nn.MetricsRecorder()
+        np.random.seed(0)
+        start = time.perf_counter()
+        params = nn.train_model(*train, 0.15, iterations,
+                                batch_size=batch_size, dtype=dtype,
+                                hidden=hidden, validation=held_out,
+                                patience=wait, callbacks=[recorder])
+        seconds = time.perf_counter() - start
+        prediction = nn.Predictor(params).predict(held_out[0])
+        results[f"train_model/{name}"] = {
+            "seconds": seconds, "iterations": len(recorder.history),
+            "samples_per_second": train[1].size*len(recorder.history)/seconds,
+            "val_accuracy": float(nn.accuracy(prediction, held_out[1]))}
+
+    #the saving is worked out from the iterations that were skipped and how
+    # long an iteration of the fixed run took, so two runs of the same length
+    # save exactly nothing instead of however much the timings happened to
+    # differ by.
+    fixed = results["train_model/fixed"]
+    early = results["train_model/early_stopping"]
+    skipped = fixed["iterations"] - early["iterations"]
+    early["seconds_saved"] = skipped * fixed["seconds"] / fixed["iterations"]
+    early["fraction_saved"] = skipped / fixed["iterations"]
+    return results
+
+#checks that the faster code paths give the same answers as the annotated
+# reference functions. Each check records the largest difference found and
+# whether it is within tolerance for the type of number used.
+def check_equivalence(X, Y, hidden, dtype, steps=3, alpha=0.15):
+    tolerance = 1e-9 if np.dtype(dtype) == np.float64 else 1e-3
+    X_scaled = nn.scale_input(X, dtype)
+    checks = {}
+
+    def record(name, difference):
+        checks[name] = {"max_abs_difference": float(difference),
+                        "tolerance": tolerance,
+                        "passed": bool(difference <= tolerance)}
+
+    #the TrainingEngine against for_prop, back_prop and update_wb, starting
+    # from the same two layer paramaters.
+    np.random.seed(0)
+    start = list(nn.initial_params(X.shape[0], dtype))
+    reference = [p.copy() for p in start]
+    engine = nn.TrainingEngine([p.copy() for p in start])
+    for _ in range(steps):
+        reference = reference_step(X_scaled, Y, reference, alpha)
+        engine.step(*engine.load_batch(X, Y), alpha)
+    record("engine_vs_reference_two_layer",
+           max(np.abs(a - b).max() for a, b in zip(reference, engine.params)))
+
+    #the TrainingEngine against the N layer reference functions.
+    np.random.seed(0)
+    start = nn.initial_layers([X.shape[0], *hidden, 10], dtype)
+    reference = [p.copy() for p in start]
+    engine = nn.TrainingEngine([p.copy() for p in start])
+    for _ in range(steps):
+        reference_layers_step(X_scaled, Y, reference, alpha)
+        engine.step(*engine.load_batch(X, Y), alpha)
+    record("engine_vs_reference_layers",
+           max(np.abs(a - b).max() for a, b in zip(reference, engine.params)))
+
+    #the TrainingEngine's mini-batch path (shuffled batches picked out with
+    # np.take) against the N layer reference functions on the same columns.
+    np.random.seed(0)
+    start = nn.initial_layers([X.shape[0], *hidden, 10], dtype)
+    batches = list(nn.batch_indices(Y.size, 256))[:steps]
+    minibatch = [p.copy() for p in start]
+    engine = nn.TrainingEngine([p.copy() for p in start])
+    for index in batches:
+        reference_layers_step(X_scaled[:, index], Y[index], minibatch, alpha)
+        engine.step(*engine.load_batch(X, Y, index), alpha)
+    record("engine_minibatch_vs_reference",
+           max(np.abs(a - b).max() for a, b in zip(minibatch, engine.params)))
+
+    #train_model with two worker processes (DataParallelEngine) against one,
+    # from the same seed, for full-batch and mini-batch training.
+    for mode, batch_size in (("full_batch", None), ("minibatch", 256)):
+        trained = []
+        for workers in (1, 2):
+            np.random.seed(0)
+            trained.append(nn.train_model(X, Y, alpha, steps,
+                                          batch_size=batch_size, dtype=dtype,
+                                          hidden=hidden, workers=workers))
+        record(f"workers_vs_single_{mode}",
+               max(np.abs(a - b).max() for a, b in zip(*trained)))
+
+    #the Predictor against for_prop_layers, on the trained paramaters.
+    _, As = nn.for_prop_layers(X_scaled, reference)
+    predictor = nn.Predictor(reference)
+    record("predictor_proba_vs_reference",
+           np.abs(predictor.predict_proba(X) - As[-1]).max())
+    record("predictor_argmax_mismatches",
+           np.sum(predictor.predict(X) != nn.predictions(As[-1])))
+    return checks
+
+#prints how every timing changed compared to an earlier results file.
+def compare(results, old_path):
+    with open(old_path) as file:
+        old = json.load(file)["results"]
+    print(f"\ncompared to {old_path}:")
+    for name, result in results.items():
+        if name in old and "min_seconds" in result:
+            change = result["min_seconds"] / old[name]["min_seconds"] - 1
+            print(f"{name:>36}: {change:+7.1%}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=20000,
+                        help="number of synthetic data points")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 32, 256, 2048, 20000])
+    parser.add_argument("--hidden", type=int, nargs="+", default=[10])
+    parser.add_argument("--dtype", choices=["float64", "float32"],
+                        default="float64")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=3,
+                        help="iterations for the train_model benchmark")
+    parser.add_argument("--stopping-iterations", type=int, default=30,
+                        help="most iterations for the early stopping benchmark")
+    parser.add_argument("--patience", type=int, default=3,
+                        help="patience for the early stopping benchmark")
+    parser.add_argument("--augment-workers", type=int, default=2,
+                        help="threads for the augmentation benchmark")
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON results to")
+    parser.add_argument("--compare", default=None,
+                        help="earlier JSON results to compare against")
+    args = parser.parse_args(argv)
+
+    hidden = tuple(args.hidden)
+    batch_sizes = [b for b in args.batch_sizes if b <= args.samples]
+    X, Y = synthetic_mnist(args.samples)
+
+    results = {}
+    results.update(bench_training(X, Y, batch_sizes, hidden, args.dtype,
+                                  args.repeats))
+    results.update(bench_inference(X, batch_sizes, hidden, args.dtype,
+                                   args.repeats))
+    results.update(bench_train_model(X, Y, hidden, args.dtype, 256,
+                                     args.iterations))
+    results.update(bench_early_stopping(X, Y, hidden, args.dtype, 256,
+                                        args.stopping_iterations,
+                                        args.patience,
+                                        min(2000, args.samples//5)))
+    results.update(bench_augmentation(X, Y, hidden, args.dtype, 256,
+                                      args.iterations, args.augment_workers))
+    checks = check_equivalence(X[:, :2000], Y[:2000], hidden, args.dtype)
+
+    report = {
+        "config": {"samples": args.samples, "batch_sizes": batch_sizes,
+                   "hidden": list(hidden), "dtype": args.dtype,
+                   "repeats": args.repeats,
+                   "stopping_iterations": args.stopping_iterations,
+                   "patience": args.patience},
+        "environment": {"python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "machine": platform.machine(),
+                        "system": platform.system()},
+        "results": results,
+        "equivalence": checks,
+        "peak_rss_bytes": peak_rss(),
+    }
+
+    print(f"\n{'benchmark':>36} {'min ms':>9} {'samples/s':>12} {'alloc KB':>10}")
+    for name, result in results.items():
+        if "min_seconds" in result:
+            print(f"{name:>36} {result['min_seconds']*1000:>9.3f} "
+                  f"{result['samples_per_second']:>12,.0f} "
+                  f"{result['alloc_bytes']/1024:>10,.1f}")
+        else:
+            print(f"{name:>36} {result['seconds']*1000:>9.1f} "
+                  f"{result['samples_per_second']:>12,.0f}")
+    early = results["train_model/early_stopping"]
+    print(f"early stopping: {early['iterations']} of "
+          f"{results['train_model/fixed']['iterations']} iterations, "
+          f"{early['seconds_saved']:.2f} s ({early['fraction_saved']:.0%}) "
+          f"saved, validation accuracy {early['val_accuracy']:.3%} vs "
+          f"{results['train_model/fixed']['val_accuracy']:.3%}")
+    augmented = results["train_model/augmented"]
+    print(f"augmentation: {augmented['augment_images_per_second']:,.0f} "
+          f"images/s, {augmented['fraction_waiting']:.0%} of training spent "
+          f"waiting with {augmented['augment_workers']} threads")
+    for name, check in checks.items():
+        status = "ok" if check["passed"] else "FAILED"
+        print(f"{name:>36}: {check['max_abs_difference']:.3g} {status}")
+    if report["peak_rss_bytes"] is not None:
+        print(f"peak RSS: {report['peak_rss_bytes']/2**20:.1f} MB")
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    #a failed equivalence check fails the run, so it can be used in scripts.
+    return 0 if all(check["passed"] for check in checks.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,19 +15,55 @@ get the most out of this. Please feel free to let me know if you have any questi
 #libraries used for our neural network
 
 #used for extra math components
+import math
 import numpy as np
 
-#works with some numpy functions - not necessary in this context
-import pandas as pd
-
 #basic data manipulation
 import pickle
 
-#importing our dataset of handwritten numbers
-from keras.datasets import mnist
+#used to read and write our model files
+import os
+import json
+import struct
+
+#used to write checkpoints in the background while training continues, and to
+# get augmented batches ready while training (see AUGMENTATION)
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#used to time our functions and measure how much memory they allocate
+import time
+import tracemalloc
+
+#used to train on several processor cores at once
+import multiprocessing
+from multiprocessing import shared_memory
+
+#used to remember predictions we have already made (see PredictionCache)
+import hashlib
+from collections import OrderedDict
+
+#used to run the script from the command line (see the MAIN section)
+import argparse
+
+#used to read the dataset of handwritten numbers
+import gzip
+import subprocess
+import sys
 
-#used to visualize the handwritten image
-import matplotlib.pyplot as plt
+#matplotlib, used to visualize the handwritten image, takes a long time to
+# import, so it is only imported inside show_prediction when it is needed.
+
+#our scale factor we use so that the data is digestible by our model and our
+# printing functions. The raw pixel values go from 0 to 255, and dividing by
+# 255 turns them into values from 0 to 1.
+SCALE_FACTOR = 255
+
+#the width and height of the images in pixels. Every MNIST image is 28x28.
+WIDTH = 28
+HEIGHT = 28
 
 #basic ReLU - return the maximum value. If the max value is negative, return 0.
 def ReLU(x):
@@ -46,8 +82,11 @@ def soft_max(x):
 
     #incase our values are too high for the exponentiation, we want to minus all
     # the values by the maximum so they are easier to deal with
-    # (for the computer).
-    x = x - np.max(x)
+    # (for the computer). Every column is its own data point, so each column
+    # uses its own maximum (axis=0). Using the maximum of the whole array could
+    # still leave some columns so small that they all round down to 0.
+    # + keepdims=True keeps the result as a (1,m) array so it lines up with x.
+    x = x - np.max(x, axis=0, keepdims=True)
 
     #getting our eulers numbers.
     exp_x = np.exp(x)
@@ -59,13 +98,33 @@ def soft_max(x):
 #this creates the starting weight(W) and bias(b) values for our neural network.
 #since it doesn't matter about the starting values due to the learning process,
 #these values can be randomized.
-def initial_params(size):
-    W1 = np.random.rand(10,size) - 0.5
-    b1 = np.random.rand(10,1) - 0.5
-    W2 = np.random.rand(10,10) - 0.5
-    b2 = np.random.rand(10,1) - 0.5
+# + dtype is the type of number we store our values as. np.float64 (the default)
+# uses 8 bytes per value, np.float32 uses 4 bytes, which halves the memory and
+# lets the computer do roughly twice as many calculations at once.
+def initial_params(size, dtype=np.float64):
+    W1 = (np.random.rand(10,size) - 0.5).astype(dtype)
+    b1 = (np.random.rand(10,1) - 0.5).astype(dtype)
+    W2 = (np.random.rand(10,10) - 0.5).astype(dtype)
+    b2 = (np.random.rand(10,1) - 0.5).astype(dtype)
     return W1,b1,W2,b2
 
+#turns input data into the type of number our model uses. The raw MNIST pixels
+# are stored as whole numbers from 0 to 255 (np.uint8, 1 byte each), which is 8
+# times smaller than storing them already scaled as np.float64, so we keep them
+# that way and only apply our scale factor when the data is actually used.
+def scale_input(X, dtype=np.float64):
+
+    #X - input data, either raw pixels (whole numbers) or already scaled values
+    #dtype - the type of number we want back
+
+    #np.issubdtype checks whether X holds whole numbers (integers).
+    if np.issubdtype(X.dtype, np.integer):
+        return np.divide(X, SCALE_FACTOR, dtype=dtype)
+
+    #already scaled, so we only change the type if we need to (copy=False means
+    # no copy is made when X already has the right type).
+    return X.astype(dtype, copy=False)
+
 #our forward propagation algorithm. This takes in our input array and applies
 #our activation function (ReLu) and then calculates the output probabilities
 #using our softmax function.
@@ -110,9 +169,15 @@ def for_prop(X,W1,b1,W2,b2):
 #marks 1 corresponding to the category that the item falls under (for example,
 # if there are 5 categories and the item falls under the 3rd one, the 3rd column
 # is marked with 1 as so: [0,0,1,0,0]).
-def one_hot(Y):
+def one_hot(Y, classes=None, dtype=np.float64):
 
     #Y = data set of our annotated digits
+    #classes - number of categories (rows). If it is not given we work it out
+    # from the labels, but a small batch may not contain every digit, so the
+    # training code always passes the size of the prediction layer.
+    #dtype - the type of numbers in the array. The training code passes the
+    # type of the prediction layer so that a np.float32 model is not turned
+    # into np.float64 when the one hot array is taken away from it.
 
     #creates a one hot array using the training set.
     # + np.zeros creates an array with 0s to start
@@ -121,7 +186,9 @@ def one_hot(Y):
     # + Y.size gives us how many examples there are in the training set.
     #this all together creates an array of 0s with 10 categories (rows) and
     # in this case 6000 examples (columns).
-    one_hot_Y = np.zeros((Y.max()+1,Y.size))
+    if classes is None:
+        classes = Y.max()+1
+    one_hot_Y = np.zeros((classes,Y.size), dtype)
 
     #changes the appropriate value in the array from 0 to 1. This method is
     # using numpy's advanced array indexing.
@@ -153,7 +220,7 @@ def back_prop(X, Y, A1, A2, W2, Z1, m):
 
     #turning the annotated dataset into a one hot array to compare our computed
     # values against
-    one_hot_Y = one_hot(Y)
+    one_hot_Y = one_hot(Y, A2.shape[0], A2.dtype)
 
     #creating an array that has the differences in values between the computed
     # prediction layer and the correct prediction layer. This is essentially
@@ -288,104 +355,2152 @@ def accuracy(prediction, Y):
     # how many predictions were correct (returned true) for the entire Y array.
     return np.sum(prediction == Y)/Y.size
 
+#===DATA===
+#the MNIST dataset comes as four IDX files: the training images and labels
+# (60000 of each) and the testing images and labels (10000 of each). These
+# functions read them straight into numpy, without needing a big library such
+# as keras to do it for us. You can download the files from the MNIST website
+# and put them in a folder (they can be left gzipped).
+MNIST_FILES = {"train": ("train-images-idx3-ubyte", "train-labels-idx1-ubyte"),
+               "test": ("t10k-images-idx3-ubyte", "t10k-labels-idx1-ubyte")}
+
+#finds an MNIST file in directory. The files are often named with a dot
+# before "idx" (train-images.idx3-ubyte) and may be gzipped.
+def find_idx(directory, name):
+    dotted = name.replace("-idx", ".idx")
+    for candidate in (name, dotted, name + ".gz", dotted + ".gz"):
+        path = os.path.join(directory, candidate)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"could not find {name} in {directory}")
+
+#reads one IDX file into a numpy array.
+# + an IDX file starts with 2 zero bytes, a byte giving the type of number
+# (8 means whole numbers from 0 to 255), a byte giving the number of dimensions,
+# and then the size of each dimension as a 4 byte number, biggest byte first
+# (">" in struct). The numbers themselves follow.
+def read_idx(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as file:
+        data = file.read()
+    zero, kind, ndim = struct.unpack(">HBB", data[:4])
+    if zero != 0 or kind != 8:
+        raise ValueError(f"{path} is not an IDX file of unsigned bytes")
+    shape = struct.unpack(f">{ndim}I", data[4:4+4*ndim])
+    return np.frombuffer(data, np.uint8, offset=4+4*ndim).reshape(shape)
+
+#loads the MNIST dataset from the IDX files in directory, in the same format
+# as our model uses: X is (784, m), one column per image, and Y has the m
+# labels. With dtype=np.uint8 (the default) X holds the raw pixels, which
+# train_model and Predictor scale as they go. Any other dtype gives X already
+# divided by our scale factor.
+# + reading and rearranging the IDX files every time is slow, so the finished
+# arrays are saved as .npy files in cache_dir (the same folder by default). The
+# next time, those are opened as memory maps (mmap_mode="r"), which is nearly
+# instant, and only the parts that are used are read from the disk.
+def load_mnist(directory, cache_dir=None, dtype=np.uint8):
+
+    #directory - folder containing the MNIST IDX files
+    #cache_dir - folder to keep the .npy files in
+    #dtype - the type of number X is stored as
+
+    cache_dir = directory if cache_dir is None else cache_dir
+    dtype = np.dtype(dtype)
+
+    data = []
+    for split, (images, labels) in MNIST_FILES.items():
+        images = find_idx(directory, images)
+        labels = find_idx(directory, labels)
+        X_path = os.path.join(cache_dir, f"mnist_{split}_X_{dtype.name}.npy")
+        Y_path = os.path.join(cache_dir, f"mnist_{split}_Y.npy")
+
+        #rebuilding the cache if it is missing or older than the IDX files.
+        newest = max(os.path.getmtime(images), os.path.getmtime(labels))
+        if not all(os.path.exists(path) and os.path.getmtime(path) >= newest
+                   for path in (X_path, Y_path)):
+            X = read_idx(images)
+            Y = read_idx(labels)
+
+            #making sure the files fit together before anything is cached, as
+            # a mistake here would otherwise only show up part way through
+            # training.
+            if X.shape[1:] != (HEIGHT, WIDTH):
+                raise ValueError(f"{images} has images of size {X.shape[1:]}, "
+                                 f"not {(HEIGHT, WIDTH)}")
+            if Y.ndim != 1:
+                raise ValueError(f"{labels} is not a list of labels")
+            if X.shape[0] != Y.size:
+                raise ValueError(f"{images} has {X.shape[0]} images but "
+                                 f"{labels} has {Y.size} labels")
+            X = np.ascontiguousarray(X.reshape(X.shape[0], -1).T)
+            if dtype != np.uint8:
+                X = scale_input(X, dtype)
+
+            #the cache folder is only made once there is something to put in
+            # it, so a failed load doesn't leave an empty folder behind.
+            os.makedirs(cache_dir, exist_ok=True)
+            for path, array in ((X_path, X), (Y_path, Y)):
+
+                #writing to a temporary file first, so that another process
+                # never sees a half written cache file.
+                with open(f"{path}.tmp", "wb") as file:
+                    np.save(file, array)
+                os.replace(f"{path}.tmp", path)
+
+        X = np.load(X_path, mmap_mode="r")
+        Y = np.load(Y_path, mmap_mode="r")
+        if X.shape[1] != Y.size:
+            raise ValueError(f"the cached {split} set has {X.shape[1]} images "
+                             f"but {Y.size} labels, delete {X_path} and "
+                             f"{Y_path} to rebuild it")
+        data.append((X, Y))
+
+    #(X_train, Y_train), (X_test, Y_test)
+    return tuple(data)
+
+#splits off the last "size" data points of a dataset to check the model on
+# while it trains (a validation set, see VALIDATION). The model never trains on
+# these, so they tell us how well it does on images it hasn't seen, without
+# using up the testing set. MNIST's training set is already in a random order,
+# so the last data points are as good a sample as any.
+# + slicing the columns gives views, so nothing is copied (even for memmaps).
+def split_validation(X, Y, size):
+
+    #X - dataset of training values, one column per data point
+    #Y - dataset of correct annotations for each column of X
+    #size - number of data points to hold out
+
+    if not 0 < size < Y.size:
+        raise ValueError(f"validation size must be between 1 and {Y.size-1}, "
+                         f"not {size}")
+    m = Y.size - size
+
+    #(X_train, Y_train), (X_validation, Y_validation)
+    return (X[:, :m], Y[:m]), (X[:, m:], Y[m:])
+
+#measures how long it takes before training can start: importing numpy, this
+# script (and keras, which this script used to load the data with, if it is
+# installed) in a fresh python, loading the dataset from the IDX files, and
+# loading it again from the cache.
+def benchmark_startup(directory, cache_dir=None):
+
+    #directory - folder containing the MNIST IDX files
+    #cache_dir - folder for the cache, removed first so we time a cold start
+
+    results = {}
+
+    #importing in a new python process, since modules that are already
+    # imported in this one would take no time at all.
+    for name, module in (("import numpy", "numpy"),
+                         ("import this script", "neuralnetworks_rs"),
+                         ("import keras", "keras.datasets.mnist")):
+        start = time.perf_counter()
+        finished = subprocess.run([sys.executable, "-c", f"import {module}"],
+                                  capture_output=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        if finished.returncode == 0:
+            results[name] = time.perf_counter() - start
+
+    cache_dir = directory if cache_dir is None else cache_dir
+    for split in MNIST_FILES:
+        for path in (f"mnist_{split}_X_uint8.npy", f"mnist_{split}_Y.npy"):
+            if os.path.exists(os.path.join(cache_dir, path)):
+                os.remove(os.path.join(cache_dir, path))
+    for name in ("load (no cache)", "load (cached)"):
+        start = time.perf_counter()
+        load_mnist(directory, cache_dir)
+        results[name] = time.perf_counter() - start
+
+    for name, seconds in results.items():
+        print(f"{name:>18}: {seconds*1000:8.1f} ms")
+    return results
+
+#===LAYERS===
+#everything above is written for exactly two layers (784 -> 10 -> 10). A hidden
+# layer with only 10 nodes can't learn very much, so the functions below do the
+# same thing for any number of layers of any size. Instead of W1, b1, W2, b2 we
+# keep our paramaters in one list, [W1, b1, W2, b2, W3, b3, ...], and loop over
+# the layers. Every layer except the last uses ReLU, and the last uses softmax.
+
+#creates the starting weights and bias' for a network with the given layer
+# sizes, for example [784, 128, 64, 10] for two hidden layers of 128 and 64
+# nodes.
+# + we use "He" initialization. Rather than random values from -0.5 to 0.5, the
+# weights are drawn from a normal distribution (np.random.randn) and scaled by
+# sqrt(2/n), where n is the number of nodes feeding into the layer. This keeps
+# the values about the same size from layer to layer, which matters a lot once
+# layers are wide or there are many of them. The last layer feeds softmax
+# rather than ReLU, so it uses sqrt(1/n). The bias' can simply start at 0.
+def initial_layers(sizes, dtype=np.float64):
+
+    #sizes - number of nodes in each layer, starting with the input layer
+    #dtype - the type of number we store our values as
+
+    params = []
+    for l in range(1, len(sizes)):
+        n = sizes[l-1]
+        gain = 2 if l < len(sizes)-1 else 1
+        W = np.random.randn(sizes[l], n) * np.sqrt(gain/n)
+        params.append(W.astype(dtype))
+        params.append(np.zeros((sizes[l], 1), dtype))
+
+    #params - [W1, b1, W2, b2, ...]
+    return params
+
+#the sizes of the layers of a list of paramaters, the opposite of
+# initial_layers.
+def layer_sizes(params):
+    return [params[0].shape[1]] + [W.shape[0] for W in params[0::2]]
+
+#forward propagation through every layer. It works exactly like for_prop, but
+# in a loop. Returns lists of the weighted sums (Z) and node values (A) of every
+# layer, so Zs[0] is Z1, As[-1] is the prediction layer, and so on.
+def for_prop_layers(X, params):
+
+    #X - testing data set
+    #params - [W1, b1, W2, b2, ...]
+
+    #L - number of layers (each layer has a W and a b)
+    L = len(params)//2
+    Zs = []
+    As = []
+
+    #the input layer is our data.
+    A = X
+    for l in range(L):
+        W, b = params[2*l], params[2*l+1]
+        Z = W.dot(A) + b
+        if l < L-1:
+            A = ReLU(Z)
+        else:
+            A = soft_max(Z)
+        Zs.append(Z)
+        As.append(A)
+    return Zs, As
+
+#backward propagation through every layer. It works exactly like back_prop,
+# but starts at the last layer and loops back towards the first, each layer
+# passing its error (dZ) back to the layer before it.
+def back_prop_layers(X, Y, Zs, As, params, m):
+
+    #X - images of the digits, in pixel arrays
+    #Y - annotated digits
+    #Zs, As - the weighted sums and node values from for_prop_layers
+    #params - [W1, b1, W2, b2, ...]
+    #m - size of our training set
+
+    L = len(params)//2
+    grads = [None] * len(params)
+
+    #the error of our prediction layer, the same as in back_prop.
+    dZ = 2*(As[-1] - one_hot(Y, As[-1].shape[0], As[-1].dtype))
+    for l in reversed(range(L)):
+
+        #the node values feeding into this layer (the input layer for l = 0)
+        A_prev = X if l == 0 else As[l-1]
+        grads[2*l] = 1/m * dZ.dot(A_prev.T)
+        grads[2*l+1] = 1/m * np.sum(dZ, 1, keepdims=True)
+
+        #passing the error back to the layer before, like dZ1 in back_prop.
+        if l > 0:
+            dZ = params[2*l].T.dot(dZ) * dx_ReLU(Zs[l-1])
+
+    #grads - [dW1, db1, dW2, db2, ...]
+    return grads
+
+#the same as update_wb, for every layer.
+def update_layers(alpha, params, grads):
+    for param, grad in zip(params, grads):
+        param -= alpha * grad
+    return params
+
+#softmax, the one hot labels and the error of the prediction layer all in one
+# go. back_prop makes a whole (10,m) one hot array just to take it away from
+# A2, but since it is 0 everywhere except one place in every column, we can
+# instead take 1 away from the probability of the right digit in each column
+# directly. This works on Z, the weighted sums of the prediction layer, and
+# writes 2*(soft_max(Z) - one_hot(Y)) * scale into out (which can be Z itself),
+# the same dZ2 as back_prop but without ever making the one hot array.
+# + with return_loss=True it also returns the total cross-entropy loss,
+# -log(probability of the right digit) added up over the columns. Working it
+# out from the weighted sums is more accurate than taking the log of the
+# probabilities: -log(e^z / sum(e^Z)) = log(sum(e^Z)) - z.
+# + buffers lets the TrainingEngine give us the small work arrays (a (1,m)
+# array, np.arange(m), and two more arrays of m values) so that no m sized
+# arrays are created. The sums still ask numpy for about 1 KB of scratch
+# memory each time.
+def softmax_cross_entropy(Z, Y, out=None, scale=1, return_loss=False,
+                          buffers=None):
+
+    #Z - weighted sums of the prediction layer, one column per data point
+    #Y - the right digit for every column
+    #out - array to write the result into (a new one if None)
+    #scale - number to multiply the result by, for example 1/m
+    #return_loss - whether to also return the total loss
+    #buffers - (column, columns, index, picked) work arrays, or None to create
+    # them
+
+    classes, m = Z.shape
+    if out is None:
+        out = np.empty_like(Z)
+    if buffers is None:
+        buffers = (np.empty((1, m), Z.dtype), np.arange(m),
+                   np.empty(m, np.intp), np.empty(m, Z.dtype))
+    column, columns, index, picked = buffers
+
+    #the position of the right digit of every column in the flattened array
+    # (row Y, column i is number Y*m + i), so np.take and np.put can get to
+    # them without any temporary arrays.
+    # + index.dtype.type(m) makes m the same type of number as index, so that
+    # labels stored as small whole numbers (np.uint8) can't overflow.
+    np.multiply(Y, index.dtype.type(m), out=index)
+    np.add(index, columns, out=index)
+
+    #subtracting the maximum of each column, as in soft_max.
+    np.max(Z, axis=0, keepdims=True, out=column)
+    np.subtract(Z, column, out=out)
+
+    #the (shifted) weighted sum of the right digit, for the loss.
+    if return_loss:
+        np.take(out, index, out=picked, mode="clip")
+        right = picked.sum()
+
+    #the probabilities, the same as soft_max.
+    np.exp(out, out=out)
+    np.sum(out, axis=0, keepdims=True, out=column)
+    np.divide(out, column, out=out)
+
+    #taking 1 away at the right digit of every column, instead of taking away
+    # a whole one hot array.
+    np.take(out, index, out=picked, mode="clip")
+    picked -= 1
+    np.put(out, index, picked, mode="clip")
+
+    #the 2 from back_prop (dZ2 = 2*(A2 - one_hot_Y)) and our scale.
+    np.multiply(out, 2*scale, out=out)
+
+    if return_loss:
+        return out, float(np.log(column, out=column).sum() - right)
+    return out
+
+#the functions above are written to be easy to read, but every time they run
+# they create brand new arrays for every Z, A, the one hot labels and all of the
+# gradients. With 60000 training examples these are big arrays, and asking the
+# computer for that much memory (and giving it back) every single iteration
+# takes a lot of time. This class does exactly the same maths, but it creates
+# all of those arrays once and then keeps writing over them.
+# + the only memory a step still asks for is numpy's own scratch space for
+# adding the bias' and taking sums (under 70 KB, see forward), which does not
+# grow with the number of data points.
+# + most numpy functions accept an "out" argument, which tells numpy to put the
+# answer into an array that we already have instead of making a new one. For
+# example np.add(a, b, out=c) does the same thing as c = a + b.
+class TrainingEngine:
+
+    #params - [W1, b1, W2, b2, ...], which are updated in place.
+    #optimizer - how the gradients are used to update the paramaters (see
+    # OPTIMIZERS). Plain gradient descent, the same as update_layers, if None.
+    def __init__(self, params, optimizer=None):
+        self.params = params
+        self.optimizer = SGD() if optimizer is None else optimizer
+
+        #one set of work arrays for each batch size we see. In mini-batch mode
+        # there are normally only two sizes, the batch size and the last batch.
+        self.workspaces = {}
+
+    #creates (only the first time) the work arrays for a batch of m data points.
+    # Lists hold one array per layer.
+    # + for the hidden layers we only keep A, since ReLU is applied to Z in
+    # place. We don't need Z afterwards, since Z > 0 exactly where A > 0.
+    def workspace(self, m):
+        ws = self.workspaces.get(m)
+        if ws is None:
+            sizes = layer_sizes(self.params)
+            dtype = self.params[0].dtype
+            ws = {
+                #the forward propagation values of every layer
+                "A": [np.empty((n, m), dtype) for n in sizes[1:]],
+                #the back propagation values of every layer, and the work
+                # arrays of softmax_cross_entropy
+                "softmax": (np.empty((1, m), dtype), np.arange(m),
+                            np.empty(m, np.intp), np.empty(m, dtype)),
+                "dZ": [np.empty((n, m), dtype) for n in sizes[1:]],
+                "mask": [np.empty((n, m), bool) for n in sizes[1:-1]],
+                "grads": [np.empty_like(p) for p in self.params],
+            }
+            self.workspaces[m] = ws
+        return ws
+
+    #gets a work array for the batch itself, creating it only the first time it
+    # is needed (full-batch training with the right dtype never needs one).
+    def batch_buffer(self, ws, name, shape, dtype):
+        buffer = ws.get(name)
+        if buffer is None or buffer.dtype != dtype:
+            buffer = ws[name] = np.empty(shape, dtype)
+        return buffer
+
+    #gets the batch ready for training and returns it. The columns in index are
+    # copied from X and Y into our batch arrays (index=None means we use all of
+    # them), and X is converted to the type of number our paramaters use. Raw
+    # pixels (whole numbers) are scaled here, one batch at a time.
+    # + np.take is the same as X[:, index], but can write into our array. We use
+    # mode="clip" since the default mode makes a temporary copy first.
+    # + in full-batch mode (index=None) the batch is the same data every time,
+    # so it is only scaled the first time and the scaled copy is reused after
+    # that. This does keep a float copy of the whole training set, like the
+    # original scale_input did, but scaling 60000 images every iteration would
+    # take over a third of the time of each step. We remember which array was
+    # scaled (where its numbers are in memory and its shape), so a different X
+    # is scaled again. The data in X must not be changed while training.
+    def load_batch(self, X, Y, index=None):
+        dtype = self.params[0].dtype
+        size = X.shape[0]
+        m = Y.size if index is None else index.size
+        ws = self.workspace(m)
+
+        if index is None:
+            raw = X
+        else:
+            raw = self.batch_buffer(ws, "X_raw", (size, m), X.dtype)
+            np.take(X, index, axis=1, out=raw, mode="clip")
+            labels = self.batch_buffer(ws, "Y", (m,), Y.dtype)
+            Y = np.take(Y, index, out=labels, mode="clip")
+
+        #already the right type, nothing else to do.
+        if raw.dtype == dtype:
+            return raw, Y
+
+        batch = self.batch_buffer(ws, "X", (size, m), dtype)
+
+        #the array that holds the numbers of raw (views of the same array, such
+        # as X[:, lo:hi], give the same answer every time), where they start and
+        # how they are laid out. Keeping the array itself in ws means it can't
+        # be freed and another array made in the same place.
+        source = None
+        if index is None:
+            owner = raw if raw.base is None else raw.base
+            source = (owner, raw.__array_interface__["data"][0], raw.shape,
+                      raw.strides, raw.dtype)
+            scaled = ws.get("X_source")
+            if (scaled is not None and scaled[0] is owner
+                    and scaled[1:] == source[1:] and batch.dtype == dtype):
+                return batch, Y
+
+        if np.issubdtype(raw.dtype, np.integer):
+            np.divide(raw, SCALE_FACTOR, out=batch, dtype=dtype)
+        else:
+            np.copyto(batch, raw)
+        ws["X_source"] = source
+        return batch, Y
+
+    #the same as for_prop_layers, writing into our work arrays, except that it
+    # stops at the weighted sums of the prediction layer, which it returns.
+    # softmax is applied by softmax_cross_entropy in backward, and we don't need
+    # it to know which digit was predicted (the largest weighted sum is also the
+    # largest probability).
+    def forward(self, X, ws):
+        params = self.params
+        L = len(params)//2
+        A_prev = X
+        for l in range(L):
+            W, b, A = params[2*l], params[2*l+1], ws["A"][l]
+
+            #Z = W.dot(A_prev) + b, written into A
+            # + adding the (n,1) bias to every column makes numpy stretch b
+            # across the batch in a small buffer of its own (at most 8192
+            # values, about 64 KB), even with out=. That buffer is the same
+            # size whatever the batch size is, so a step still only allocates
+            # a bounded amount of memory and never a new batch sized array.
+            np.dot(W, A_prev, out=A)
+            np.add(A, b, out=A)
+
+            #A = ReLU(Z) for the hidden layers
+            if l < L-1:
+                np.maximum(A, 0, out=A)
+            A_prev = A
+        return A
+
+    #the same as back_prop_layers, writing into our work arrays. With
+    # return_loss=True it returns the total cross-entropy loss of the batch.
+    def backward(self, X, Y, ws, m, return_loss=False):
+        params, grads, As, dZs = self.params, ws["grads"], ws["A"], ws["dZ"]
+        L = len(params)//2
+
+        #dZ = 2*(soft_max(Z) - one_hot(Y)) for the prediction layer, already
+        # multiplied by 1/m. Every gradient is worked out from dZ, so they all
+        # come out multiplied by 1/m as well, and we don't need to multiply
+        # each of them by 1/m separately.
+        dZ = softmax_cross_entropy(As[-1], Y, out=dZs[-1], scale=1/m,
+                                   return_loss=return_loss,
+                                   buffers=ws["softmax"])
+        loss = None
+        if return_loss:
+            dZ, loss = dZ
+
+        for l in reversed(range(L)):
+            A_prev = X if l == 0 else As[l-1]
+            dW, db = grads[2*l], grads[2*l+1]
+
+            #dW = 1/m * dZ.dot(A_prev.T) and db = 1/m * np.sum(dZ,1)
+            np.dot(dZ, A_prev.T, out=dW)
+            np.sum(dZ, axis=1, keepdims=True, out=db)
+
+            #dZ_prev = W.T.dot(dZ)*dx_ReLU(Z_prev). Multiplying by the
+            # true/false array would make numpy convert it to numbers in a
+            # temporary array, so instead we mark where the previous layer's
+            # nodes are 0 (Z <= 0) and set dZ_prev to 0 in those places.
+            if l > 0:
+                dZ_prev, mask = dZs[l-1], ws["mask"][l-1]
+                np.dot(params[2*l].T, dZ, out=dZ_prev)
+                np.less_equal(A_prev, 0, out=mask)
+                np.copyto(dZ_prev, 0, where=mask)
+                dZ = dZ_prev
+        return loss
+
+    #updates the paramaters in place with our optimizer, using the learning
+    # rate alpha.
+    def update(self, alpha, ws):
+        self.optimizer.step(self.params, ws["grads"], alpha)
+
+    #one full training step (forward prop, back prop, update) on the batch X, Y.
+    # Returns the prediction layer weighted sums (which are overwritten next
+    # step).
+    def step(self, X, Y, alpha):
+        m = Y.size
+        ws = self.workspace(m)
+        A = self.forward(X, ws)
+        self.backward(X, Y, ws, m)
+        self.update(alpha, ws)
+        return A
+
+    #loads the batch of columns in index (None for all of them) and trains on
+    # it. This is what train_model calls.
+    # + stats is a dictionary from new_stats(), or None. When it is given we
+    # also time every phase of the step and add up the loss and number of
+    # correct predictions into it. When it is None we skip all of that, so it
+    # costs nothing.
+    def train_batch(self, X, Y, index, alpha, stats=None):
+        if stats is None:
+            X_batch, Y_batch = self.load_batch(X, Y, index)
+            self.step(X_batch, Y_batch, alpha)
+            return
+
+        clock = time.perf_counter
+        start = clock()
+        X_batch, Y_batch = self.load_batch(X, Y, index)
+        m = Y_batch.size
+        ws = self.workspace(m)
+        loaded = clock()
+        Z = self.forward(X_batch, ws)
+        forwarded = clock()
+        correct = int(np.sum(predictions(Z) == Y_batch))
+        evaluated = clock()
+        loss = self.backward(X_batch, Y_batch, ws, m, return_loss=True)
+        backwarded = clock()
+        self.update(alpha, ws)
+        updated = clock()
+
+        stats["samples"] += m
+        stats["correct"] += correct
+        stats["loss"] += loss
+        phases = stats["phases"]
+        phases["load"] += loaded - start
+        phases["forward"] += forwarded - loaded
+        phases["evaluate"] += evaluated - forwarded
+        phases["backward"] += backwarded - evaluated
+        phases["update"] += updated - backwarded
+
+#training on several processor cores at once (data parallel training). Every
+# batch is split into equal shards, one for each worker process. Each worker
+# runs forward and back propagation on its shard, and then we add up the
+# gradients of all the shards and update the paramaters once, in this process.
+# Since back_prop averages over the batch (the 1/m), the workers scale by the
+# size of the whole batch so that the sum of their gradients is exactly the
+# gradient of the whole batch. The result is the same as TrainingEngine (up to
+# the order numbers are added in), but the work is split between cores.
+# + processes don't share memory, and sending the 60000 column training set to
+# each of them would mean copying it over and over. Instead the training set,
+# the paramaters and the gradients live in shared memory, which every process
+# can read and write, so the only things sent to the workers are small
+# messages such as "run columns 0 to 15000".
+# + numpy's matrix maths can use several cores on its own. When using many
+# workers it is usually best to limit it to one core per worker by setting the
+# environment variable OMP_NUM_THREADS=1 before starting python.
+class DataParallelEngine:
+
+    #params - [W1, b1, W2, b2, ...]
+    #X - dataset of training values
+    #Y - dataset of correct annotations for each column of X
+    #workers - number of worker processes
+    #optimizer - how the gradients are used to update the paramaters
+    def __init__(self, params, X, Y, workers, optimizer=None):
+        self.workers = workers
+        self.optimizer = SGD() if optimizer is None else optimizer
+        self.blocks = []
+        self.connections = []
+        self.processes = []
+
+        #if anything goes wrong part way through, we stop the workers that
+        # were started and free the shared memory that was created.
+        try:
+            self.start(params, X, Y)
+        except BaseException:
+            self.close()
+            raise
+
+    #creates the shared arrays and starts the workers.
+    def start(self, params, X, Y):
+        workers = self.workers
+
+        #the training data, shared with the workers.
+        self.X = self.shared(X.shape, X.dtype)
+        self.X[...] = X
+        self.Y = self.shared(Y.shape, np.intp)
+        self.Y[...] = Y
+
+        #the order of the columns of the current batch (mini-batch mode only).
+        self.index = self.shared(Y.shape, np.intp)
+
+        #all the paramaters in one flat shared array, and self.params as views
+        # into it, so updating the flat array updates every W and b at once.
+        dtype = params[0].dtype
+        shapes = [p.shape for p in params]
+        total = sum(p.size for p in params)
+        self.flat_params = self.shared((total,), dtype)
+        self.params = self.unflatten(self.flat_params, shapes)
+        for view, param in zip(self.params, params):
+            view[...] = param
+
+        #one row of gradients per worker, and the array we add them up into.
+        self.grads = self.shared((workers, total), dtype)
+        self.grad_sum = np.empty(total, dtype)
+        self.grad_views = self.unflatten(self.grad_sum, shapes)
+
+        #starting the workers. Each one gets the names of the shared arrays (not
+        # the arrays themselves) and one end of a pipe to receive messages on.
+        names = [(block.name, array.shape, array.dtype.str)
+                 for block, array in zip(self.blocks,
+                     (self.X, self.Y, self.index, self.flat_params, self.grads))]
+        for rank in range(workers):
+            parent_end, child_end = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=parallel_worker, args=(rank, names, shapes, child_end),
+                daemon=True)
+            process.start()
+            self.connections.append(parent_end)
+            self.processes.append(process)
+
+    #creates an array in a new block of shared memory.
+    def shared(self, shape, dtype):
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self.blocks.append(block)
+        return np.ndarray(shape, dtype, buffer=block.buf)
+
+    #splits a flat array into views with the given shapes, one after another.
+    @staticmethod
+    def unflatten(flat, shapes):
+        views = []
+        offset = 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            views.append(flat[offset:offset+size].reshape(shape))
+            offset += size
+        return views
+
+    #trains on the batch of columns in index (None for all of them), in the
+    # same way as TrainingEngine.train_batch. X and Y are not used, since the
+    # workers use the shared copies. The phases we time are "workers" (loading,
+    # forward and back propagation in the workers) and "update".
+    def train_batch(self, X, Y, index, alpha, stats=None):
+        clock = time.perf_counter
+        start = clock()
+        if index is None:
+            m = self.Y.size
+        else:
+            m = index.size
+            self.index[:m] = index
+
+        #sending each worker the part of the batch (positions lo to hi) it
+        # works on, then waiting for all of them to finish.
+        measure = stats is not None
+        for rank in range(self.workers):
+            lo = rank * m // self.workers
+            hi = (rank+1) * m // self.workers
+            self.send(rank, ("step", index is not None, lo, hi, m, measure))
+        replies = [self.receive(rank) for rank in range(self.workers)]
+        computed = clock()
+
+        #adding up the gradients of the shards and updating the paramaters with
+        # our optimizer. The optimizer sees each W and b separately (as views),
+        # the same as with TrainingEngine, so its state is the same shape.
+        np.sum(self.grads, axis=0, out=self.grad_sum)
+        self.optimizer.step(self.params, self.grad_views, alpha)
+
+        if measure:
+            stats["samples"] += m
+            for correct, loss in replies:
+                stats["correct"] += correct
+                stats["loss"] += loss
+            stats["phases"]["workers"] += computed - start
+            stats["phases"]["update"] += clock() - computed
+
+    #sends a message to one worker, and waits for the reply of one worker. If
+    # the worker has died (from an error, or being killed) its end of the pipe
+    # is closed, and we say which one it was instead of just "EOFError" or
+    # "BrokenPipeError".
+    def send(self, rank, message):
+        try:
+            self.connections[rank].send(message)
+        except OSError as error:
+            self.died(rank, error)
+
+    def receive(self, rank):
+        try:
+            return self.connections[rank].recv()
+        except (EOFError, OSError) as error:
+            self.died(rank, error)
+
+    def died(self, rank, error):
+        process = self.processes[rank]
+        process.join(timeout=1)
+        raise RuntimeError(f"worker {rank} died (exit code "
+                           f"{process.exitcode})") from error
+
+    #stops the workers and frees the shared memory. Copy self.params first if
+    # you still need them.
+    # + this is also called after something has gone wrong, so a worker may
+    # already be dead (sending to it fails) or stuck. Workers that don't stop
+    # within a few seconds are terminated, and the shared memory is always
+    # freed, since it would otherwise stay in use until the computer restarts.
+    def close(self):
+        try:
+            for connection in self.connections:
+                try:
+                    connection.send(("stop",))
+                except OSError:
+                    pass
+            for process in self.processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            for connection in self.connections:
+                connection.close()
+        finally:
+            self.X = self.Y = self.index = self.flat_params = self.grads = None
+            self.params = self.grad_views = None
+            for block in self.blocks:
+                block.close()
+                block.unlink()
+            self.blocks = []
+
+#the function every DataParallelEngine worker process runs. It connects to the
+# shared arrays, then waits for messages until it is told to stop.
+def parallel_worker(rank, names, shapes, connection):
+
+    #rank - which worker this is (0, 1, 2, ...)
+    #names - (name, shape, dtype) of each shared array
+    #shapes - shapes of the paramaters
+    #connection - our end of the pipe to the main process
+
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in names]
+    X, Y, index, flat_params, grads = (
+        np.ndarray(shape, dtype, buffer=block.buf)
+        for block, (_, shape, dtype) in zip(blocks, names))
+
+    #our engine works directly on the shared paramaters, and our gradients are
+    # copied into our row of the shared gradients after every step.
+    engine = TrainingEngine(DataParallelEngine.unflatten(flat_params, shapes))
+    my_grads = DataParallelEngine.unflatten(grads[rank], shapes)
+
+    while True:
+        message = connection.recv()
+        if message[0] == "stop":
+            break
+        _, shuffled, lo, hi, m, measure = message
+
+        #with more workers than columns, some shards are empty.
+        if hi == lo:
+            grads[rank] = 0
+            connection.send((0, 0.0))
+            continue
+
+        #our shard of the batch. In full-batch mode that is simply columns lo to
+        # hi, otherwise it is the columns at positions lo to hi of the batch.
+        if shuffled:
+            X_batch, Y_batch = engine.load_batch(X, Y, index[lo:hi])
+        else:
+            X_batch, Y_batch = engine.load_batch(X[:, lo:hi], Y[lo:hi])
+
+        #forward and back propagation, averaging over the whole batch (m).
+        ws = engine.workspace(hi - lo)
+        Z = engine.forward(X_batch, ws)
+        correct = int(np.sum(predictions(Z) == Y_batch)) if measure else 0
+        loss = engine.backward(X_batch, Y_batch, ws, m, return_loss=measure)
+        for grad, my_grad in zip(ws["grads"], my_grads):
+            np.copyto(my_grad, grad)
+
+        connection.send((correct, loss or 0.0))
+
+    #the arrays must be let go of before the shared memory can be closed.
+    del X, Y, index, flat_params, grads, engine, my_grads
+    for block in blocks:
+        block.close()
+
+#===OPTIMIZERS===
+#update_wb uses plain gradient descent: every step it moves the paramaters a
+# fixed amount (alpha) in the direction of the gradient. That takes about 200
+# iterations to train our model. The optimizers below get there in far fewer:
+# + momentum keeps a running total (the "velocity") of past gradients, so that
+# steps that keep going the same way speed up, like a ball rolling downhill,
+# and steps that keep changing direction cancel out.
+# + Nesterov momentum is the same, but looks ahead to where the velocity is
+# about to take us before adding the gradient, which makes it more stable.
+# + Adam keeps a running average of the gradients and of the gradients squared
+# for every single paramater, and divides one by the square root of the other,
+# so every paramater gets its own step size. It usually works well with a
+# learning rate of about 0.001.
+#every optimizer has the same methods:
+# + step(params, grads, alpha) - updates the paramaters in place. The gradients
+# are used as work space, so they are changed as well.
+# + state_dict() - (arrays, info), everything needed to carry on later, which
+# is saved in checkpoints
+# + load_state_dict(arrays, info) - carries on from a state_dict()
+#the state arrays are created the first time step() is called, and everything
+# is done in place so that no new arrays are needed after that.
+
+#gradient descent, with optional momentum (and Nesterov momentum). With the
+# default momentum of 0 this is exactly update_layers.
+class SGD:
+
+    #momentum - how much of the velocity is kept every step, usually 0.9
+    #nesterov - whether to use Nesterov momentum
+    def __init__(self, momentum=0.0, nesterov=False):
+        self.momentum = momentum
+        self.nesterov = nesterov
+        self.velocity = None
+
+    def step(self, params, grads, alpha):
+        if not self.momentum:
+            for param, grad in zip(params, grads):
+                np.multiply(grad, alpha, out=grad)
+                np.subtract(param, grad, out=param)
+            return
+
+        if self.velocity is None:
+            self.velocity = [np.zeros_like(param) for param in params]
+        for param, grad, velocity in zip(params, grads, self.velocity):
+
+            #velocity = momentum*velocity + grad
+            np.multiply(velocity, self.momentum, out=velocity)
+            np.add(velocity, grad, out=velocity)
+
+            #the step is the velocity, or for Nesterov momentum,
+            # grad + momentum*velocity, worked out in grad.
+            if self.nesterov:
+                np.multiply(grad, 1/self.momentum, out=grad)
+                np.add(grad, velocity, out=grad)
+                np.multiply(grad, alpha*self.momentum, out=grad)
+            else:
+                np.multiply(velocity, alpha, out=grad)
+            np.subtract(param, grad, out=param)
+
+    def state_dict(self):
+        arrays = {}
+        if self.velocity is not None:
+            arrays = {f"velocity{i}": v for i, v in enumerate(self.velocity)}
+        return arrays, {"name": "sgd", "momentum": self.momentum,
+                        "nesterov": self.nesterov}
+
+    def load_state_dict(self, arrays, info):
+        check_optimizer(self, info)
+        if arrays:
+            self.velocity = [arrays[f"velocity{i}"].copy()
+                             for i in range(len(arrays))]
+
+#the Adam optimizer.
+# + m and v (the running averages) start at 0, so for the first few steps they
+# are too small. Dividing them by 1 - beta^t (t is the number of steps) fixes
+# this. We fold that into the learning rate and epsilon, so it costs nothing.
+class Adam:
+
+    #beta1 - how much of the average gradient is kept every step
+    #beta2 - how much of the average squared gradient is kept every step
+    #epsilon - a tiny number that stops us dividing by 0
+    def __init__(self, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.t = 0
+        self.m = None
+        self.v = None
+        self.work = None
+
+    def step(self, params, grads, alpha):
+        if self.m is None:
+            self.m = [np.zeros_like(param) for param in params]
+            self.v = [np.zeros_like(param) for param in params]
+        if self.work is None:
+            self.work = [np.empty_like(param) for param in params]
+        self.t += 1
+        correction = math.sqrt(1 - self.beta2**self.t)
+        step_size = alpha * correction / (1 - self.beta1**self.t)
+        epsilon = self.epsilon * correction
+
+        for param, grad, m, v, work in zip(params, grads, self.m, self.v,
+                                           self.work):
+
+            #m = beta1*m + (1-beta1)*grad
+            np.multiply(m, self.beta1, out=m)
+            np.multiply(grad, 1 - self.beta1, out=work)
+            np.add(m, work, out=m)
+
+            #v = beta2*v + (1-beta2)*grad^2
+            np.multiply(v, self.beta2, out=v)
+            np.multiply(grad, grad, out=work)
+            np.multiply(work, 1 - self.beta2, out=work)
+            np.add(v, work, out=v)
+
+            #param -= step_size * m / (sqrt(v) + epsilon)
+            np.sqrt(v, out=work)
+            np.add(work, epsilon, out=work)
+            np.divide(m, work, out=work)
+            np.multiply(work, step_size, out=work)
+            np.subtract(param, work, out=param)
+
+    def state_dict(self):
+        arrays = {}
+        if self.m is not None:
+            for i, (m, v) in enumerate(zip(self.m, self.v)):
+                arrays[f"m{i}"] = m
+                arrays[f"v{i}"] = v
+        return arrays, {"name": "adam", "beta1": self.beta1,
+                        "beta2": self.beta2, "epsilon": self.epsilon,
+                        "t": self.t}
+
+    def load_state_dict(self, arrays, info):
+        check_optimizer(self, info)
+        self.t = info["t"]
+        if arrays:
+            count = len(arrays)//2
+            self.m = [arrays[f"m{i}"].copy() for i in range(count)]
+            self.v = [arrays[f"v{i}"].copy() for i in range(count)]
+
+#makes sure a saved optimizer state is for the same kind of optimizer.
+def check_optimizer(optimizer, info):
+    name = optimizer.state_dict()[1]["name"]
+    if info.get("name", name) != name:
+        raise ValueError(f"the checkpoint was made with the {info['name']} "
+                         f"optimizer, not {name}")
+
+#learning rate schedules change the learning rate as training goes on. Large
+# steps early on make fast progress, and smaller steps at the end let the model
+# settle into a good spot. A schedule is called with the starting learning rate
+# (alpha) and the iteration, counting from 0, and returns the learning rate for
+# that iteration.
+
+#multiplies the learning rate by factor every "every" iterations.
+class StepSchedule:
+    def __init__(self, every, factor=0.1):
+        self.every = every
+        self.factor = factor
+
+    def __call__(self, alpha, iteration):
+        return alpha * self.factor ** (iteration // self.every)
+
+#lowers the learning rate from alpha to final along half a cosine wave over
+# total iterations, slowly at first, then faster, then slowly again.
+class CosineSchedule:
+    def __init__(self, total, final=0.0):
+        self.total = total
+        self.final = final
+
+    def __call__(self, alpha, iteration):
+        progress = min(iteration, self.total) / self.total
+        return self.final + (alpha - self.final) * (1 + math.cos(math.pi*progress))/2
+
+#raises the learning rate in a straight line from almost 0 to alpha over the
+# first "warmup" iterations, which stops big early steps from throwing the
+# random starting paramaters too far. After that it follows the "after"
+# schedule (counting from 0 again) or stays at alpha.
+class WarmupSchedule:
+    def __init__(self, warmup, after=None):
+        self.warmup = warmup
+        self.after = after
+
+    def __call__(self, alpha, iteration):
+        if iteration < self.warmup:
+            return alpha * (iteration + 1) / self.warmup
+        if self.after is None:
+            return alpha
+        return self.after(alpha, iteration - self.warmup)
+
+#===AUGMENTATION===
+#a model that sees the same 60000 images over and over starts to remember them
+# instead of learning what makes a digit a digit (overfitting), which larger
+# models do sooner. Augmentation changes every image a little every time it is
+# used, in ways that don't change which digit it is, so the model never sees
+# exactly the same image twice:
+# + shifts - moving the digit a couple of pixels in any direction
+# + rotations - turning it a few degrees around the middle of the image
+# + elastic distortion - bending it slightly, as if drawn by a different hand.
+# Every pixel is moved by a random amount, and the amounts are smoothed
+# (blurred) so that neighbouring pixels move together.
+#all of these move pixels around, so they are done the same way: for every
+# pixel of the new image we work out where in the old image it comes from, and
+# take the value there. Those positions are usually between pixels, so we mix
+# the 4 nearest pixels in proportion to how close they are (bilinear
+# interpolation). Positions outside the image are 0 (black).
+
+#a matrix that blurs along one side of an image with a gaussian ("bell curve")
+# of width sigma pixels. Multiplying a (HEIGHT, WIDTH) field by it on both sides
+# blurs it in both directions.
+def gaussian_matrix(n, sigma):
+    distance = np.arange(n)[:, None] - np.arange(n)[None, :]
+    G = np.exp(-distance**2 / (2 * sigma**2))
+    return G / G.sum(axis=1, keepdims=True)
+
+#randomly shifts, rotates and distorts every image (column) of images, which
+# can be raw pixels or scaled values. Returns a new array of the same shape and
+# type of number.
+def augment_images(images, rng, shift=2.0, rotation=10.0, elastic=34.0,
+                   sigma=4.0):
+
+    #images - one image per column, (784, m)
+    #rng - a numpy random Generator (np.random.default_rng)
+    #shift - most pixels to move an image in each direction
+    #rotation - most degrees to rotate an image by
+    #elastic - how far the distortion moves pixels (0 for none). The random
+    # amounts are from -1 to 1 before they are smoothed, which makes them much
+    # smaller, so this is large.
+    #sigma - how smooth the distortion is, in pixels
+
+    m = images.shape[1]
+    pictures = images.T.reshape(m, HEIGHT, WIDTH)
+
+    #everything is worked out with float32, which is plenty for positions
+    # within a 28x28 image and twice as fast as float64.
+    # + the position of every pixel of the new images, measured from the middle,
+    # and moved back by the shift.
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH].astype(np.float32)
+    middle_y, middle_x = (HEIGHT - 1)/2, (WIDTH - 1)/2
+    dx, dy = rng.uniform(-shift, shift, (2, m, 1, 1)).astype(np.float32)
+    x = x - middle_x - dx
+    y = y - middle_y - dy
+
+    #rotating back by the angle tells us where each pixel came from.
+    angle = np.radians(rng.uniform(-rotation, rotation, (m, 1, 1)))
+    cos, sin = np.cos(angle).astype(np.float32), np.sin(angle).astype(np.float32)
+    source_x = cos*x
+    source_x += sin*y
+    source_x += middle_x
+    source_y = cos*y
+    source_y -= sin*x
+    source_y += middle_y
+
+    #the elastic distortion, blurred with our gaussian matrices.
+    if elastic:
+        field = rng.random((2, m, HEIGHT, WIDTH), np.float32)
+        field -= 0.5
+        blur_y = gaussian_matrix(HEIGHT, sigma).astype(np.float32)
+        blur_x = gaussian_matrix(WIDTH, sigma).astype(np.float32)
+        field = blur_y @ field @ blur_x.T
+        field *= 2 * elastic
+        source_x += field[0]
+        source_y += field[1]
+
+    #a border of zeros around every image (1 pixel before it and 2 after), so
+    # that positions just outside the image mix in black. Anything further out
+    # is moved onto the border.
+    padded = np.zeros((m, HEIGHT + 3, WIDTH + 3), np.float32)
+    padded[:, 1:HEIGHT+1, 1:WIDTH+1] = pictures
+    np.clip(source_x, -1, WIDTH, out=source_x)
+    np.clip(source_y, -1, HEIGHT, out=source_y)
+    x0 = np.floor(source_x)
+    y0 = np.floor(source_y)
+    fx = source_x - x0
+    fy = source_y - y0
+
+    #the position in padded of the top left of the 4 nearest pixels, counting
+    # every pixel of every image in order (so that np.take can fetch them all
+    # at once).
+    row = WIDTH + 3
+    corner = (y0.astype(np.intp) + 1) * row
+    corner += x0.astype(np.intp) + 1
+    corner += np.arange(m)[:, None, None] * (HEIGHT + 3) * row
+    flat = padded.ravel()
+    left = np.take(flat, corner)
+    top = left + fx*(np.take(flat, corner + 1) - left)
+    left = np.take(flat, corner + row)
+    bottom = left + fx*(np.take(flat, corner + row + 1) - left)
+    new = top + fy*(bottom - top)
+
+    #back to one image per column, rounding raw pixels to whole numbers.
+    new = new.reshape(m, HEIGHT*WIDTH).T
+    if np.issubdtype(images.dtype, np.integer):
+        np.rint(new, out=new)
+    return np.ascontiguousarray(new, dtype=images.dtype)
+
+#the settings of augment_images, as an object that train_model can call on
+# every batch. See augment_images for what each setting does.
+class Augmenter:
+    def __init__(self, shift=2.0, rotation=10.0, elastic=34.0, sigma=4.0):
+        self.shift = shift
+        self.rotation = rotation
+        self.elastic = elastic
+        self.sigma = sigma
+
+    def __call__(self, images, rng):
+        return augment_images(images, rng, self.shift, self.rotation,
+                              self.elastic, self.sigma)
+
+#fetches the columns of one batch and augments them. Runs in a worker thread.
+# Every batch gets its own random number generator, made from the seed of the
+# epoch and the number of the batch, so the results don't depend on which
+# worker gets which batch.
+def make_augmented_batch(X, Y, index, augment, seed, number):
+    rng = np.random.default_rng([seed, number])
+    return augment(np.take(X, index, axis=1), rng), np.take(Y, index)
+
+#a generator that hands out the augmented batches of one epoch, in the order of
+# batches (from batch_indices). The batches are made by the threads of pool,
+# while we train on earlier ones.
+# + at most prefetch batches are being made or waiting at a time, so a slow
+# training step never lets them pile up in memory.
+# + numpy lets go of python while it works on large arrays, so the threads
+# really do run at the same time as training.
+def augmented_batches(X, Y, batches, augment, pool, prefetch=4):
+
+    #X - dataset of training values, one column per data point
+    #Y - dataset of correct annotations for each column of X
+    #batches - the indices of every batch (see batch_indices)
+    #augment - an Augmenter, or any function(images, rng) returning images
+    #pool - the ThreadPoolExecutor to make the batches with
+    #prefetch - most batches being made or waiting at once
+
+    seed = np.random.randint(2**31)
+    pending = deque()
+    try:
+        for number, index in enumerate(batches):
+            pending.append(pool.submit(make_augmented_batch, X, Y, index,
+                                       augment, seed, number))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+
+        #training stopped part way through the epoch.
+        for future in pending:
+            future.cancel()
+
+#===VALIDATION===
+#the accuracy on the data a model trains on keeps going up for as long as we
+# train, but after a while the model is only memorizing those images, and it
+# stops getting better (or gets worse) on images it hasn't seen. To see when
+# that happens, train_model can check the model on a validation set (see
+# split_validation) every few iterations. Early stopping then ends training
+# once the validation accuracy stops improving, and we keep the paramaters from
+# the best check rather than the last one.
+# + checking is forward propagation only, done through a Predictor in large
+# chunks, which is far cheaper than a training iteration.
+
+#keeps track of the best validation accuracy so far, and decides when to stop.
+class EarlyStopping:
+
+    #patience - number of checks in a row without improvement before we stop,
+    # or None to never stop early (but still keep the best paramaters)
+    #min_delta - how much the accuracy must go up by to count as improving
+    def __init__(self, patience=None, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_accuracy = -1.0
+        self.best_iteration = None
+        self.best_params = None
+        self.waited = 0
+
+    #records the accuracy of a check. A copy of the paramaters is kept if they
+    # are the best so far (into the same arrays every time). Returns True if
+    # training should stop.
+    def update(self, iteration, accuracy, params):
+        if accuracy > self.best_accuracy + self.min_delta:
+            self.best_accuracy = accuracy
+            self.best_iteration = iteration
+            self.waited = 0
+            if self.best_params is None:
+                self.best_params = [param.copy() for param in params]
+            else:
+                for best, param in zip(self.best_params, params):
+                    np.copyto(best, param)
+            return False
+        self.waited += 1
+        return self.patience is not None and self.waited >= self.patience
+
+    #(arrays, info), everything needed to carry on later, which is saved in
+    # checkpoints the same way as the state of an optimizer (see OPTIMIZERS).
+    def state_dict(self):
+        arrays = {}
+        if self.best_params is not None:
+            arrays = {f"param{i}": p for i, p in enumerate(self.best_params)}
+        return arrays, {"best_accuracy": self.best_accuracy,
+                        "best_iteration": self.best_iteration,
+                        "waited": self.waited}
+
+    #carries on from a state_dict().
+    def load_state_dict(self, arrays, info):
+        self.best_accuracy = info["best_accuracy"]
+        self.best_iteration = info["best_iteration"]
+        self.waited = info["waited"]
+        self.best_params = None
+        if arrays:
+            self.best_params = [arrays[f"param{i}"].copy()
+                                for i in range(len(arrays))]
+
+#===METRICS===
+#train_model can tell us what is happening while it trains through callbacks.
+# A callback is an object with the methods of TrainingCallback below, which
+# train_model calls at the start of training, after every iteration and at the
+# end. The metrics it is given are:
+# + iteration - the iteration that just finished
+# + seconds - how long the iteration took
+# + samples_per_second - data points trained on per second
+# + loss - the average cross-entropy loss, -log(probability of the right digit)
+# + accuracy - the fraction of data points predicted correctly
+# + val_accuracy - the accuracy on the validation set, on iterations where it
+# was checked (see VALIDATION)
+# + phases - seconds spent in each phase of training: "augment" (waiting for
+# the next augmented batch, see AUGMENTATION), "load" (getting the batch
+# ready), "forward", "evaluate" (the accuracy), "backward" (including the loss)
+# and "update" ("workers" and "update" with more than one worker)
+#all of this is only measured when there are callbacks, so training without
+# them doesn't slow down at all.
+
+#the dictionary TrainingEngine.train_batch adds up its measurements in.
+def new_stats():
+    return {"samples": 0, "correct": 0, "loss": 0.0,
+            "phases": dict.fromkeys(["augment", "load", "forward", "evaluate",
+                                     "backward", "update", "workers"], 0.0)}
+
+#the callback that does nothing. Make your own callbacks by inheriting from it
+# and replacing the methods you need.
+class TrainingCallback:
+
+    #info - iterations, first iteration, number of data points, batch size,
+    # layer sizes and number of workers
+    def on_train_begin(self, info):
+        pass
+
+    #metrics - see the list above
+    def on_iteration_end(self, iteration, metrics):
+        pass
+
+    #params - the trained paramaters
+    def on_train_end(self, params):
+        pass
+
+#a callback that keeps the metrics of every iteration in memory (history), and
+# if given a path also writes them to that file, one line of JSON each, as soon
+# as every iteration ends.
+# + the file is opened (to add to the end) and closed again for every line
+# instead of being kept open for the whole of training. That costs very little
+# next to an iteration, and means nothing is left open if training stops with
+# an error (or Ctrl-C) before on_train_end.
+class MetricsRecorder(TrainingCallback):
+
+    #path - file to add the metrics to, or None to only keep them in memory
+    def __init__(self, path=None):
+        self.path = path
+        self.info = None
+        self.history = []
+
+    def on_train_begin(self, info):
+        self.info = info
+
+    def on_iteration_end(self, iteration, metrics):
+        self.history.append(metrics)
+        if self.path is not None:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(metrics) + "\n")
+
+    #the total seconds spent in each phase over all iterations, and the fraction
+    # of the time each phase took.
+    def summary(self):
+        totals = {}
+        for metrics in self.history:
+            for phase, seconds in metrics["phases"].items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+        total = sum(totals.values()) or 1.0
+        return {phase: {"seconds": seconds, "fraction": seconds/total}
+                for phase, seconds in totals.items()}
+
+#a generator that hands out the column numbers (indices) of each mini-batch.
+# Since it is a generator (it uses yield instead of return), only one batch is
+# ever made at a time, so the memory we need depends on the batch size and not
+# on the size of the whole dataset.
+def batch_indices(m, batch_size, shuffle=True):
+
+    #m - number of data points
+    #batch_size - how many data points (columns) go in each batch
+    #shuffle - whether we mix up the order of the data points first
+
+    #every time we go through the data (an epoch) we shuffle the order of the
+    # columns, so the model doesn't see the batches in the same order every time.
+    # + np.random.permutation(m) gives us the numbers 0 to m (exc) in a random
+    # order.
+    if shuffle:
+        order = np.random.permutation(m)
+    else:
+        order = np.arange(m)
+
+    #stepping through our (shuffled) order batch_size columns at a time. The
+    # last batch may be smaller if m does not divide evenly.
+    for start in range(0, m, batch_size):
+        yield order[start:start+batch_size]
+
 #the main function in our neural network. utilizes the previous functions we
 # created to train a model and returns the final values.
-def train_model(X, Y, alpha, iterations):
+# + there are two modes. By default (batch_size=None) every iteration runs on
+# the full training set, which is the original "full-batch" gradient descent.
+# If a batch_size is given, every iteration is instead one pass (epoch) over
+# the shuffled training set in mini-batches, updating the paramaters after
+# every batch. This is mini-batch stochastic gradient descent, which makes many
+# more (smaller) updates per pass over the data and so needs far fewer passes.
+def train_model(X, Y, alpha, iterations, batch_size=None, shuffle=True,
+                dtype=np.float64, hidden=(10,), workers=1, checkpoint_path=None,
+                checkpoint_every=None, resume_from=None, callbacks=None,
+                optimizer=None, schedule=None, validation=None,
+                validate_every=1, patience=None, min_delta=0.0, augment=None,
+                augment_workers=2, prefetch=4):
 
     #X - dataset of training values
     #Y - dataset of correct annotations for each training value from X
     #alpha - our learning rate (used in updating bias' & weights)
-    #iterations - number of iterations of training cycles
+    #iterations - number of iterations of training cycles (epochs when we
+    # train in mini-batches)
+    #batch_size - size of each mini-batch, or None for full-batch training
+    #shuffle - whether to shuffle the data every epoch (mini-batch mode only)
+    #dtype - the type of number used for the paramaters and all calculations.
+    # X can be raw pixels (np.uint8), which are scaled one batch at a time (or
+    # once, in full-batch mode).
+    #hidden - number of nodes in each hidden layer, so (10,) is the original
+    # 784 -> 10 -> 10 network and (128, 64) would be 784 -> 128 -> 64 -> 10.
+    #workers - number of processes to train with (see DataParallelEngine)
+    #checkpoint_path - file to write checkpoints to (see CHECKPOINTS)
+    #checkpoint_every - write a checkpoint every this many iterations. A last
+    # checkpoint is always written when training finishes.
+    #resume_from - a checkpoint file to carry on training from. Training then
+    # continues from the iteration the checkpoint was made at, up to iterations.
+    #callbacks - a list of callbacks to tell about our progress (see METRICS)
+    #optimizer - how the gradients are used to update the paramaters, such as
+    # SGD(momentum=0.9) or Adam() (see OPTIMIZERS). Plain gradient descent if
+    # None.
+    #schedule - a learning rate schedule, such as CosineSchedule(iterations).
+    # The learning rate stays at alpha if None.
+    #validation - (X_validation, Y_validation) to check the model on while it
+    # trains (see VALIDATION). The paramaters from the best check are returned.
+    #validate_every - check the validation set every this many iterations
+    #patience - stop once this many checks in a row haven't improved the
+    # validation accuracy by more than min_delta. Never stops early if None.
+    #augment - an Augmenter (see AUGMENTATION) to change every batch with, in
+    # the background. Only in mini-batch mode with one worker.
+    #augment_workers - number of threads making augmented batches
+    #prefetch - most augmented batches being made or waiting at once
 
     #size - number of input values per data point (784 for a 28 x 278 image)
     #m - number of data points, 6000 since that is the size of our training set
     size , m = X.shape
 
-    #creating out initial paramaters, these are randomized to start (see initial
-    # param function)
-    W1, b1, W2, b2 = initial_params(size)
+    #checking our options before anything is started.
+    if augment is not None and (batch_size is None or workers > 1):
+        raise ValueError("augmentation needs a batch_size and one worker")
+    if patience is not None and validation is None:
+        raise ValueError("early stopping (patience) needs a validation set")
+
+    #creating out initial paramaters, these are randomized to start (see
+    # initial_layers). The prediction layer has one node per digit. When
+    # resuming, we instead carry on with the paramaters and random number
+    # generator from the checkpoint.
+    optimizer = SGD() if optimizer is None else optimizer
+    if resume_from is not None:
+        (params, start, rng_state, optimizer_state,
+         stopper_state) = load_checkpoint(resume_from)
+        np.random.set_state(rng_state)
+        optimizer.load_state_dict(*optimizer_state)
+    else:
+        stopper_state = ({}, {})
+        classes = int(Y.max()) + 1
+        params = initial_layers([size, *hidden, classes], dtype)
+        start = 0
+
+    #the writer, engine and threads are started inside the try, so that the
+    # finally at the end stops whatever was started even if starting the rest
+    # fails.
+    writer = engine = pool = None
+    stopper = predictor = None
+    try:
+
+        #our checkpoint writer, which writes in the background.
+        if checkpoint_path is not None:
+            writer = CheckpointWriter(checkpoint_path)
+
+        #our training engine, which runs the same steps as for_prop_layers,
+        # back_prop_layers and update_layers but reuses its arrays (see
+        # TrainingEngine). With more than one worker, the work of every step is
+        # split between processes (see DataParallelEngine).
+        if workers > 1:
+            engine = DataParallelEngine(params, X, Y, workers, optimizer)
+        else:
+            engine = TrainingEngine(params, optimizer)
+
+        #checking our model on the validation set (see VALIDATION). The
+        # Predictor works in chunks of 4096 columns, so it only needs a little
+        # memory.
+        if validation is not None:
+            X_validation, Y_validation = validation
+            stopper = EarlyStopping(patience, min_delta)
+
+            #carrying on with the best paramaters and patience from before
+            # training was stopped.
+            if stopper_state[1]:
+                stopper.load_state_dict(*stopper_state)
+            predictor = Predictor(engine.params, chunk_size=4096)
+
+        #the threads that make our augmented batches.
+        if augment is not None:
+            pool = ThreadPoolExecutor(augment_workers)
+
+        #how often we print an update. We use max() so that we still get
+        # updates when there are fewer than 10 iterations (common for
+        # mini-batch training).
+        report_every = max(1, int(iterations/10))
+
+        #telling our callbacks that training is starting.
+        callbacks = list(callbacks or [])
+        for callback in callbacks:
+            callback.on_train_begin({"iterations": iterations, "start": start,
+                                     "samples": m, "batch_size": batch_size,
+                                     "layers": layer_sizes(params),
+                                     "workers": workers})
+
+        #this is the most important part of our neural network. Here, we run
+        # our algorithm of forward prop, back prop, and then we update the
+        # paramaters based on returned values. The iterations is how many times
+        # we are going to run our training functions. Since it takes about 200
+        # iterations for this specific model to get to a relatively high
+        # accuracy rate (we get about 80-95%), we will just do 200 iterations.
+        # You can increase this if desired.
+        # + we are setting up a for loop that will run "iterations" times.
+        for i in range(start, iterations):
+
+            #in full-batch mode there is just one "batch", the whole training
+            # set (index None), which we can use as it is. In mini-batch mode
+            # the engine copies each batch into the same arrays every time.
+            # With augmentation, the threads make every batch (X, Y) for us.
+            if batch_size is None:
+                batches = [None]
+            else:
+                batches = batch_indices(m, batch_size, shuffle)
+            if pool is not None:
+                batches = augmented_batches(X, Y, batches, augment, pool,
+                                            prefetch)
+
+            #whether this iteration is one we print an update for
+            report = (i+1) % report_every == 0
+
+            #the learning rate for this iteration.
+            rate = alpha if schedule is None else schedule(alpha, i)
+
+            #the measurements of this iteration (see METRICS). We only measure
+            # when we are about to print them or have callbacks to give them to.
+            stats = new_stats() if report or callbacks else None
+            began = time.perf_counter()
+
+            waited = time.perf_counter()
+            for batch in batches:
+
+                #an augmented batch is ready to use as it is (index None). We
+                # also measure how long we had to wait for it.
+                if pool is not None:
+                    (X_batch, Y_batch), index = batch, None
+                    if stats is not None:
+                        stats["phases"]["augment"] += time.perf_counter() - waited
+                else:
+                    X_batch, Y_batch, index = X, Y, batch
+
+                #running our forward propagation, backward propagation and
+                # updating our values based off of the results. The size we
+                # average over is the size of the batch, not of the whole
+                # training set.
+                engine.train_batch(X_batch, Y_batch, index, rate, stats)
+                waited = time.perf_counter()
+
+            #checking the validation set, with the paramaters as they are now.
+            val_accuracy = None
+            stop = False
+            if stopper is not None and ((i+1) % validate_every == 0
+                                        or i+1 == iterations):
+                predictor.load(engine.params)
+                val_accuracy = float(accuracy(predictor.predict(X_validation),
+                                              Y_validation))
+                stop = stopper.update(i+1, val_accuracy, engine.params)
+
+            #simple if statement that gives us updates every 5% of the way we
+            # are to completing the training. So, for 200 iterations it will
+            # give us an update every 10 iterations completed.
+            if report:
+
+                #printing the iteration we are on
+                print(f"Current Iteration: {i+1} / {iterations}")
+
+                #printing the accuracy of the model in this current iteration.
+                # In mini-batch mode this is the accuracy over all the batches
+                # of the epoch, which is the same as accuracy() for full-batch
+                # training.
+                print(f"Current Model Accuracy: {stats['correct']/m:.3%}")
+                if val_accuracy is not None:
+                    print(f"Validation Accuracy: {val_accuracy:.3%}")
+
+            if callbacks:
+                seconds = time.perf_counter() - began
+                metrics = {"iteration": i+1, "seconds": seconds,
+                           "learning_rate": rate,
+                           "samples_per_second": stats["samples"]/seconds,
+                           "loss": stats["loss"]/stats["samples"],
+                           "accuracy": stats["correct"]/stats["samples"],
+                           "phases": {phase: seconds for phase, seconds
+                                      in stats["phases"].items() if seconds}}
+                if val_accuracy is not None:
+                    metrics["val_accuracy"] = val_accuracy
+                for callback in callbacks:
+                    callback.on_iteration_end(i+1, metrics)
+
+            #saving a checkpoint every checkpoint_every iterations, and at the
+            # end of training.
+            if writer is not None and (i+1 == iterations or stop or (
+                    checkpoint_every and (i+1) % checkpoint_every == 0)):
+                writer.save(engine.params, i+1, optimizer, stopper)
+
+            if stop:
+                print(f"Stopping early at iteration {i+1}: the validation "
+                      f"accuracy hasn't improved for {patience} checks.")
+                break
+
+        #the paramaters of the parallel engine live in shared memory, which is
+        # freed below, so we keep a copy.
+        if workers > 1:
+            params = [param.copy() for param in engine.params]
+
+        #keeping the paramaters from the best validation check.
+        if stopper is not None and stopper.best_params is not None:
+            params = stopper.best_params
+            print(f"Best Validation Accuracy: {stopper.best_accuracy:.3%} "
+                  f"(iteration {stopper.best_iteration})")
+    finally:
+        if workers > 1 and engine is not None:
+            engine.close()
+        if writer is not None:
+            writer.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    for callback in callbacks:
+        callback.on_train_end(params)
+
+    print("Model training successfully completed.")
+    #params - our final, accurate weights and bias' [W1, b1, W2, b2, ...]
+    return params
 
-    #this is the most important part of our neural network. Here, we run our
-    # algorithm of forward prop, back prop, and then we update the paramaters
-    # based on returned values. The iterations is how many times we are going
-    # to run our training functions. Since it takes about 200 iterations for
-    # this specific model to get to a relatively high accuracy rate (we get
-    # about 80-95%), we will just do 200 iterations. You can increase this if
-    # desired.
-    # + we are setting up a for loop that will run "iterations" times.
+#compares how much memory one training step allocates with the original
+# functions (for_prop, back_prop, update_wb) and with the TrainingEngine.
+# + tracemalloc is part of python and keeps track of memory as it is allocated.
+# For every step we record the peak memory above what was in use before the
+# step started, which is the memory the step needed for its temporary arrays.
+def benchmark_step_allocations(X, Y, alpha=0.15, steps=5):
 
-    for i in range(iterations):
+    #X - dataset of training values
+    #Y - dataset of correct annotations for each training value from X
+    #alpha - learning rate
+    #steps - how many steps to measure (after one warm up step)
 
-        #running our forward propagation
-        Z1, A1, Z2, A2 = for_prop(X, W1, b1, W2, b2)
+    size, m = X.shape
+    results = {}
 
-        #running our backward propagation
+    #the original step, one call to each of the annotated functions.
+    W1, b1, W2, b2 = initial_params(size)
+    def reference_step():
+        nonlocal W1, b1, W2, b2
+        Z1, A1, Z2, A2 = for_prop(X, W1, b1, W2, b2)
         dW1, db1, dW2, db2 = back_prop(X, Y, A1, A2, W2, Z1, m)
-
-        #updating our values based off of the results.
         W1, b1, W2, b2 = update_wb(alpha, W1, b1, W2, b2, dW1, db1, dW2, db2)
 
-        #simple if statement that gives us updates every 5% of the way we are
-        # to completing the training. So, for 200 iterations it will give us an
-        # update every 10 iterations completed.
-        if (i+1) % int(iterations/10) == 0:
-
-            #printing the iteration we are on
-            print(f"Current Iteration: {i+1} / {iterations}")
-
-            #printing the accuracy of the model in this current iteration
-            prediction = predictions(A2)
-            print(f"Current Model Accuracy: {accuracy(prediction, Y):.3%}")
-
-    print("Model training successfully completed.")
-    #W1 - our final, accurate first layer of weights
-    #b1 - final values for the first layer of bias'
-    #W2 - final values for second layer of weights
-    #b2 - final values for the second layer of bias values
-    return W1, b1, W2, b2
+    #the engine step, using a copy of the same starting paramaters.
+    engine = TrainingEngine([p.copy() for p in (W1, b1, W2, b2)])
+    def engine_step():
+        engine.step(X, Y, alpha)
+
+    for name, step in (("reference", reference_step), ("engine", engine_step)):
+
+        #the first step is where the engine creates its arrays, so we don't
+        # count it.
+        step()
+
+        allocated = []
+        seconds = []
+        tracemalloc.start()
+        for _ in range(steps):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            step()
+            seconds.append(time.perf_counter() - start)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+        results[name] = {"bytes_per_step": max(allocated),
+                         "seconds_per_step": min(seconds)}
+        print(f"{name:>9}: {max(allocated):>12,} bytes allocated per step, "
+              f"{min(seconds)*1000:.1f} ms per step")
+
+    return results
+
+#trains the same model (same starting values) with np.float64 and np.float32
+# and prints how long training took, how much memory the data and work arrays
+# need, and how accurate each model is on the testing set.
+def compare_precisions(X_train, Y_train, X_test, Y_test, alpha=0.15,
+                       iterations=200, batch_size=None, hidden=(10,), seed=0):
+
+    #X_train, Y_train - the training data and labels
+    #X_test, Y_test - the testing data and labels
+    #alpha, iterations, batch_size, hidden - passed on to train_model
+    #seed - starting point for the random numbers, so both runs start the same
+
+    results = {}
+    for dtype in (np.float64, np.float32):
+        np.random.seed(seed)
+        start = time.perf_counter()
+        params = train_model(X_train, Y_train, alpha, iterations, batch_size,
+                             dtype=dtype, hidden=hidden)
+        seconds = time.perf_counter() - start
+        test_accuracy = accuracy(make_predictions(X_test, *params), Y_test)
+
+        #the size of the scaled training set at this type of number, which is
+        # what the model works on every iteration.
+        data_bytes = X_train.size * np.dtype(dtype).itemsize
+        results[np.dtype(dtype).name] = {"seconds": seconds,
+                                         "accuracy": float(test_accuracy),
+                                         "data_bytes": data_bytes}
+
+    print(f"{'dtype':>8} {'seconds':>9} {'data MB':>9} {'accuracy':>9}")
+    for name, result in results.items():
+        print(f"{name:>8} {result['seconds']:>9.2f} "
+              f"{result['data_bytes']/2**20:>9.1f} {result['accuracy']:>9.3%}")
+    speedup = results["float64"]["seconds"] / results["float32"]["seconds"]
+    print(f"float32 speedup: {speedup:.2f}x, accuracy change: "
+          f"{results['float32']['accuracy'] - results['float64']['accuracy']:+.3%}")
+    return results
+
+#===MODEL FILES===
+#pickle can save almost any python object, but loading a pickle file can run
+# any code hidden inside it, it has to read the whole file into memory, and it
+# is slow for big models. Our model files instead have a small header that
+# describes every array (its name, shape and type of number), followed by the
+# raw bytes of the arrays themselves:
+# + 8 bytes - MODEL_MAGIC, so we can tell it is one of our files
+# + 4 bytes - the format version
+# + 4 bytes - the length of the header
+# + the header, written as JSON text
+# + the arrays, starting at the first multiple of 64 bytes after the header,
+# each one starting at a multiple of 64 bytes (its "offset" in the header is
+# counted from where the arrays start)
+#since the arrays are stored exactly as they are in memory, we can use them
+# straight from the file with np.memmap, without reading them in first. The
+# operating system then only keeps one copy of the file in memory, no matter
+# how many processes are using it, and "loading" a model takes almost no time.
+MODEL_MAGIC = b"NNRSMDL\0"
+MODEL_VERSION = 1
+MODEL_ALIGNMENT = 64
+
+#writes a dictionary of named arrays (and, optionally, a dictionary of other
+# information such as the iteration we are on) to a model file.
+def write_arrays(path, arrays, metadata=None):
+
+    #path - file to write
+    #arrays - {name: array}
+    #metadata - any extra information that can be written as JSON
+
+    #rounds a number of bytes up to the next multiple of MODEL_ALIGNMENT
+    def align(n):
+        return -(-n // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+    arrays = {name: np.asarray(array, order="C") for name, array in arrays.items()}
+
+    entries = []
+    offset = 0
+    for name, array in arrays.items():
+        entries.append({"name": name, "dtype": array.dtype.str,
+                        "shape": list(array.shape), "offset": offset})
+        offset = align(offset + array.nbytes)
+    header = json.dumps({"arrays": entries, "metadata": metadata or {}}).encode()
+    start = align(16 + len(header))
+
+    with open(path, "wb") as file:
+        file.write(MODEL_MAGIC)
+        file.write(struct.pack("<II", MODEL_VERSION, len(header)))
+        file.write(header)
+        for entry, array in zip(entries, arrays.values()):
+            file.write(b"\0" * (start + entry["offset"] - file.tell()))
+            file.write(array.tobytes())
+
+#reads a file written by write_arrays. Returns the dictionary of arrays and the
+# dictionary of extra information.
+# + with mmap=True (the default) the arrays are read-only views of the file
+# itself, shared with any other process using the same file. With mmap=False
+# they are normal arrays read into memory.
+def read_arrays(path, mmap=True):
+
+    with open(path, "rb") as file:
+        if file.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise ValueError(f"{path} is not a model file")
+        version, header_length = struct.unpack("<II", file.read(8))
+        if version > MODEL_VERSION:
+            raise ValueError(f"{path} uses model format version {version}, "
+                             f"only versions up to {MODEL_VERSION} are supported")
+        header = json.loads(file.read(header_length))
+    start = -(-(16 + header_length) // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+    #the memory map is kept open for as long as any of the arrays are in use.
+    if mmap:
+        data = np.memmap(path, np.uint8, mode="r").view(np.ndarray)
+    else:
+        data = np.fromfile(path, np.uint8)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        offset = start + entry["offset"]
+        arrays[entry["name"]] = data[offset:offset+nbytes].view(dtype).reshape(shape)
+    return arrays, header["metadata"]
+
+#saves the weights and bias' of a model, [W1, b1, W2, b2, ...], to a model file.
+def save_model(path, params, metadata=None):
+    arrays = {}
+    for l in range(len(params)//2):
+        arrays[f"W{l+1}"] = params[2*l]
+        arrays[f"b{l+1}"] = params[2*l+1]
+    write_arrays(path, arrays, {"layers": layer_sizes(params), **(metadata or {})})
+
+#loads the weights and bias' saved by save_model, [W1, b1, W2, b2, ...].
+# + a quantized model (see QUANTIZATION) can't be used as float paramaters,
+# since its weights need their scales, so load it with load_quantized (or
+# load_predictor) instead.
+def load_model(path, mmap=True):
+    arrays, metadata = read_arrays(path, mmap)
+    if metadata.get("quantized"):
+        raise ValueError(f"{path} is a quantized model, load it with "
+                         f"load_quantized or load_predictor")
+    params = []
+    for l in range(len(metadata["layers"]) - 1):
+        params.append(arrays[f"W{l+1}"])
+        params.append(arrays[f"b{l+1}"])
+    return params
+
+#converts a pickle file of paramaters, such as the "trained_params.pkl" files
+# written by earlier versions of this script, to a model file.
+# + only use this on pickle files that you made yourself, since loading a
+# pickle file can run any code inside of it.
+def convert_pickle(pickle_path, model_path):
+    with open(pickle_path, "rb") as dump_file:
+        params = pickle.load(dump_file)
+    save_model(model_path, list(params))
+
+#===CHECKPOINTS===
+#a checkpoint is everything we need to carry on training from where we left
+# off: the paramaters, the iteration we are on, and the state of numpy's random
+# number generator (so the batches are shuffled exactly as they would have been
+# if training had never stopped), the state of the optimizer (see OPTIMIZERS),
+# and when training with a validation set, the best paramaters so far and how
+# long we have waited for them to improve (see VALIDATION). Checkpoints are
+# model files (see MODEL FILES) with some extra information.
+
+#takes a copy of everything that goes into a checkpoint. This must be done
+# between training steps, since training changes the paramaters in place.
+def checkpoint_state(params, iteration, optimizer=None, stopper=None):
+
+    #params - [W1, b1, W2, b2, ...]
+    #iteration - number of iterations completed
+    #optimizer - the optimizer whose state to save, if any
+    #stopper - the EarlyStopping whose state (the best paramaters so far) to
+    # save, if any
+
+    arrays = {f"param{i}": param.copy() for i, param in enumerate(params)}
+    states = {}
+    for prefix, saved in (("optimizer", optimizer), ("best", stopper)):
+        states[prefix] = {}
+        if saved is not None:
+            saved_arrays, states[prefix] = saved.state_dict()
+            for name, array in saved_arrays.items():
+                arrays[f"{prefix}/{name}"] = array.copy()
+
+    #np.random.get_state() returns the name of the generator, its 624 numbers
+    # of state, a position, and two values used for normal random numbers.
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    arrays["rng_keys"] = keys
+    metadata = {"iteration": iteration, "params": len(params),
+                "rng": [name, int(position), int(has_gauss),
+                        float(cached_gaussian)],
+                "optimizer": states["optimizer"],
+                "early_stopping": states["best"]}
+    return arrays, metadata
+
+#writes a checkpoint so that it can never be left half written. We write to a
+# temporary file first, make sure it has reached the disk (os.fsync), and then
+# rename it over the old checkpoint, which happens all at once.
+def write_checkpoint(path, arrays, metadata):
+    temporary = f"{path}.tmp"
+    write_arrays(temporary, arrays, metadata)
+    with open(temporary, "rb+") as file:
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+#writes a checkpoint of the paramaters straight away (not in the background).
+def save_checkpoint(path, params, iteration, optimizer=None, stopper=None):
+    write_checkpoint(path, *checkpoint_state(params, iteration, optimizer,
+                                             stopper))
+
+#reads a checkpoint. Returns the paramaters (as normal arrays that can be
+# trained further), the number of iterations completed, the random number
+# generator state, which can be given to np.random.set_state(), the optimizer
+# state, which can be given to the load_state_dict() method of an optimizer,
+# and the early stopping state, which can be given to
+# EarlyStopping.load_state_dict() (its info is {} if there wasn't one).
+def load_checkpoint(path):
+    arrays, metadata = read_arrays(path, mmap=False)
+    params = [arrays[f"param{i}"].copy() for i in range(metadata["params"])]
+    name, position, has_gauss, cached_gaussian = metadata["rng"]
+    rng_state = (name, arrays["rng_keys"].copy(), position, has_gauss,
+                 cached_gaussian)
+    states = {}
+    for prefix, name in (("optimizer", "optimizer"),
+                         ("best", "early_stopping")):
+        saved_arrays = {key[len(prefix)+1:]: array
+                        for key, array in arrays.items()
+                        if key.startswith(f"{prefix}/")}
+        states[prefix] = (saved_arrays, metadata.get(name, {}))
+    return (params, metadata["iteration"], rng_state, states["optimizer"],
+            states["best"])
+
+#writes checkpoints on a background thread, so that training doesn't have to
+# wait for the disk. Only one checkpoint waits to be written at a time: if the
+# disk is so slow that the next checkpoint is due before the last one has been
+# written, save() waits for it rather than using more and more memory.
+class CheckpointWriter:
+
+    #path - file the checkpoints are written to
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #the background thread. None in the queue means we are done.
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                write_checkpoint(self.path, *item)
+            except Exception as error:
+                self.error = error
+
+    #takes a copy of the training state now, and writes it in the background.
+    def save(self, params, iteration, optimizer=None, stopper=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(checkpoint_state(params, iteration, optimizer, stopper))
+
+    #waits for the last checkpoint to be written and stops the thread.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+#===INFERENCE===
+#once a model is trained we only need to make predictions with it, which needs
+# much less work than training: there are no gradients, we don't need to keep
+# the values of every layer, and since softmax never changes which node is the
+# largest, we can even skip it and take the argmax of the last weighted sums.
+# This class loads the paramaters once and then predicts as fast as it can.
+# + the data is worked through in chunks of a fixed number of columns. Small
+# arrays fit in the computer's cache (very fast memory close to the
+# processor), and the work arrays for each chunk are created only once.
+class Predictor:
+
+    #params - the trained weights and bias' [W1, b1, W2, b2, ...]
+    #chunk_size - number of data points worked on at a time
+    #cache - a PredictionCache to remember predictions in, or None
+    def __init__(self, params, chunk_size=512, cache=None):
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.load(params)
+
+    #loads (or replaces) the paramaters used for predictions.
+    # + raw pixels go from 0 to 255 and our model expects them divided by our
+    # scale factor. Instead of dividing every pixel, we divide the first layer
+    # weights once, since W1.dot(X / 255) is the same as (W1 / 255).dot(X).
+    # + loading new paramaters of the same sizes (such as the paramaters of a
+    # model part way through training) reuses the arrays we already have.
+    def load(self, params):
+        params = [np.ascontiguousarray(p) for p in params]
+        same = (hasattr(self, "params") and params[0].dtype == self.dtype
+                and layer_sizes(params) == layer_sizes(self.params))
+        self.params = params
+        self.dtype = self.params[0].dtype
+        if same:
+            np.divide(self.params[0], SCALE_FACTOR, out=self.raw_W1)
+        else:
+            self.raw_W1 = self.params[0] / self.dtype.type(SCALE_FACTOR)
+            self.workspaces = {}
+        self.loaded(params)
+
+    #called at the end of load. Predictions remembered for the old paramaters
+    # are no longer right, so the cache is cleared.
+    def loaded(self, params):
+        self.version = None
+        if self.cache is not None:
+            self.version = model_version(params)
+            self.cache.clear()
+
+    #work arrays for a chunk of m data points: the chunk itself and the node
+    # values of every layer. Created only the first time.
+    def workspace(self, m):
+        ws = self.workspaces.get(m)
+        if ws is None:
+            sizes = layer_sizes(self.params)
+            ws = {"X": np.empty((sizes[0], m), self.dtype),
+                  "A": [np.empty((n, m), self.dtype) for n in sizes[1:]]}
+            self.workspaces[m] = ws
+        return ws
+
+    #splits X into chunks, yielding the columns each chunk covers and the last
+    # layer weighted sums of that chunk (which are overwritten by the next one).
+    # X can be one image (784,) or many (784, m), raw pixels or scaled values.
+    def chunks(self, X):
+        if X.ndim == 1:
+            X = X[:, None]
+        raw = np.issubdtype(X.dtype, np.integer)
+        L = len(self.params)//2
+        m = X.shape[1]
+        for start in range(0, m, self.chunk_size):
+            stop = min(start + self.chunk_size, m)
+            ws = self.workspace(stop - start)
+
+            #copying the chunk into our work array, converting it to our type of
+            # number on the way.
+            np.copyto(ws["X"], X[:, start:stop], casting="unsafe")
+            A_prev = ws["X"]
+            for l in range(L):
+                W = self.raw_W1 if l == 0 and raw else self.params[2*l]
+                A = ws["A"][l]
+                np.dot(W, A_prev, out=A)
+                np.add(A, self.params[2*l+1], out=A)
+                if l < L-1:
+                    np.maximum(A, 0, out=A)
+                A_prev = A
+            yield start, stop, A
+
+    #the predicted digit for every column of X.
+    def predict(self, X):
+        if self.cache is not None and np.asarray(X).dtype == np.uint8:
+            return np.argmax(self.predict_proba(X), axis=0)
+        single = X.ndim == 1
+        prediction = np.empty(1 if single else X.shape[1], np.intp)
+        for start, stop, Z in self.chunks(X):
+            np.argmax(Z, axis=0, out=prediction[start:stop])
+        return prediction[0] if single else prediction
+
+    #the probability of every digit for every column of X, using softmax. Each
+    # column subtracts its own maximum before the exponent so that the values
+    # never get too large.
+    # + with a cache, raw pixels (uint8) are looked up in it first and only the
+    # images it doesn't have are worked out.
+    def predict_proba(self, X):
+        single = X.ndim == 1
+        probs = np.empty((self.params[-1].shape[0], 1 if single else X.shape[1]),
+                         self.dtype)
+        if self.cache is not None and X.dtype == np.uint8:
+            self.cache.predict(self, X[:, None] if single else X, probs)
+            return probs[:, 0] if single else probs
+        self.softmax(X, probs)
+        return probs[:, 0] if single else probs
+
+    #writes the softmax of the last layer of every column of X into probs.
+    def softmax(self, X, probs):
+        for start, stop, Z in self.chunks(X):
+            P = probs[:, start:stop]
+            np.subtract(Z, Z.max(axis=0), out=P)
+            np.exp(P, out=P)
+            P /= P.sum(axis=0)
+
+    #the k most likely digits for every column of X and their probabilities,
+    # most likely first. Both arrays have k rows and one column per data point.
+    def top_k(self, X, k=3):
+        probs = self.predict_proba(X)
+
+        #np.argsort sorts from smallest to largest, so we sort the negative
+        # probabilities and keep the first k rows.
+        digits = np.argsort(-probs, axis=0)[:k]
+        return digits, np.take_along_axis(probs, digits, axis=0)
+
+#in some uses the same images are sent to be predicted again and again
+# (retries, or the same scan sent twice). A PredictionCache remembers the
+# probabilities worked out for the most recent images so that they don't need
+# to be worked out again. Give one to a Predictor to use it.
+# + an image is looked up by a hash of its raw pixels (a short "fingerprint"
+# worked out from all 784 bytes, see image_keys) together with the version of
+# the model, so that a cache can't give an answer from different paramaters.
+# Loading new paramaters into the Predictor also clears the cache.
+# + only raw pixels (uint8) are cached, since rounding makes two float images
+# that look the same have different bytes.
+# + when it is full, the image used longest ago is forgotten (least recently
+# used, or LRU). An OrderedDict remembers the order its keys were added in,
+# and move_to_end marks a key as just used.
+class PredictionCache:
+
+    #capacity - the most images remembered
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    #forgets everything (the counters are kept).
+    def clear(self):
+        self.entries.clear()
+
+    #hits, misses, evictions, the fraction of lookups that were hits and the
+    # number of images remembered.
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries)}
+
+    #the probabilities remembered for key, or None.
+    def get(self, key):
+        probs = self.entries.get(key)
+        if probs is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return probs
+
+    def put(self, key, probs):
+        self.entries[key] = probs
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    #fills probs (one column per column of X) for the predictor. The images
+    # found in the cache are copied in, and all the rest are worked out
+    # together with one call to predictor.softmax. The same image twice in X
+    # is only worked out once.
+    def predict(self, predictor, X, probs):
+        missing = {}
+        for column, key in enumerate(image_keys(X, predictor.version)):
+            if key in missing:
+                self.hits += 1
+                missing[key].append(column)
+                continue
+            cached = self.get(key)
+            if cached is not None:
+                probs[:, column] = cached
+            else:
+                missing[key] = [column]
+        if not missing:
+            return
+
+        first = [columns[0] for columns in missing.values()]
+        new = np.empty((probs.shape[0], len(first)), probs.dtype)
+        predictor.softmax(X[:, first], new)
+        for i, (key, columns) in enumerate(missing.items()):
+            probs[:, columns] = new[:, i, None]
+            self.put(key, new[:, i].copy())
+
+#a short identifier for a set of paramaters: a hash of all their values.
+def model_version(params):
+    digest = hashlib.blake2b(digest_size=8)
+    for param in params:
+        digest.update(np.ascontiguousarray(param).tobytes())
+    return digest.digest()
+
+#the cache key of every column of X (raw pixels): a 16 byte blake2b hash of its
+# pixels, with the model version as the hash key. blake2b is one of the fastest
+# hashes in python's hashlib, and 16 bytes make it practically impossible for
+# two different images to get the same key.
+# + the columns of X are not next to each other in memory, so we copy the
+# images into rows first.
+def image_keys(X, version):
+    rows = np.ascontiguousarray(X.T)
+    key = version or b""
+    return [hashlib.blake2b(row, digest_size=16, key=key).digest()
+            for row in rows]
 
 #using the trained data we get from our previous functions, we can use this
 # function to make a final prediction; a digit from 0-9.
-def make_predictions(X, W1 ,b1, W2, b2):
+# + *params collects all of the weights and bias' we are given, so this works
+# for make_predictions(X, W1, b1, W2, b2) as well as for deeper networks.
+def make_predictions(X, *params, quantized=False):
 
     #X - our data set
-    #W1 - first layer weights
-    #b1 - first layer bias'
-    #W2 - second layer weights
-    #b2 - second layer bias'
-
-    #here we are running our forward propagation function to get a prediction
-    # using the given data set, weights, and bias' we have enetered. In this
-    # function, since we are making a final prediction, the values we are using
-    # will be the final, trained values. Since we only want the prediction layer
-    # values to make a prediction, we are only extracting the A2 array (the
-    # prediction layer) and discarding the other information.
-    _, _, _, A2 = for_prop(X, W1, b1, W2, b2)
-
-    #now, we are using our predictions function to gather a digit wise
-    # prediction from inputting the prediction values.
-    prediction = predictions(A2)
+    #params - the weights and bias' of every layer (W1, b1, W2, b2, ...)
+    #quantized - whether to predict with whole numbers (see QUANTIZATION)
+
+    #here we are running forward propagation to get a prediction using the
+    # given data set, weights, and bias' we have enetered. In this function,
+    # since we are making a final prediction, the values we are using will be
+    # the final, trained values. Since we only want the prediction layer values
+    # to make a prediction, we use a Predictor, which only calculates what it
+    # needs for that (see the Predictor class). If you are making lots of
+    # predictions with the same model, create one Predictor and reuse it.
+    if quantized:
+        prediction = QuantizedPredictor(params).predict(X)
+    else:
+        prediction = Predictor(params).predict(X)
 
     #simply returning the prediction, which will be a value from 0-9.
     return prediction
 
 #this function is used for printing our models predicted value, the correct
 # value, and an image of the handwritten digit.
-def show_prediction(index,X, Y, W1, b1, W2, b2):
+# + show=False only prints the prediction and label, without opening a window.
+# + quantized paramaters come from quantize_params or load_quantized.
+def show_prediction(index,X, Y, *params, show=True, quantized=False):
 
     #index - an index for the specific handwritten digit we are referencing
     #X - the data set we are indexing
     #Y - the array of labels for the data (used to print the correct value)
-    #W1 - first layer weights
-    #b1 - first layer bias'
-    #W2 - second layer weights
-    #b2 - second layer bias'
+    #params - the weights and bias' of every layer (W1, b1, W2, b2, ...)
+    #show - whether to show the image
+    #quantized - whether the paramaters are quantized (see QUANTIZATION)
 
     #the vector of the image's pixel values
     vect_X = X[:, index,None]
 
     #the prediction our model makes using our make_predictions function
-    prediction = make_predictions(vect_X, W1, b1, W2, b2)
+    prediction = make_predictions(vect_X, *params, quantized=quantized)
 
     #the label of the image using our index on the label array (Y)
     label = Y[index]
@@ -396,59 +2511,427 @@ def show_prediction(index,X, Y, W1, b1, W2, b2):
     #printing the label of the image
     print("Label: ", label)
 
-    #reshaping the image and applying our scale factor to normalize values
-    current_image = vect_X.reshape((WIDTH, HEIGHT)) * SCALE_FACTOR
+    if not show:
+        return
+
+    #reshaping the image and, if the data was scaled, undoing our scale factor
+    # to get the original pixel values back
+    current_image = vect_X.reshape((WIDTH, HEIGHT))
+    if np.issubdtype(current_image.dtype, np.floating):
+        current_image = current_image * SCALE_FACTOR
 
     #using matplotlib functions to print out our visualized handwritten digit.
+    import matplotlib.pyplot as plt
     plt.gray()
     plt.imshow(current_image, interpolation='nearest')
     plt.show()
 
-#===MAIN===
-
-#loading in the data we will be using
-(X_train, Y_train), (X_test, Y_test) = mnist.load_data()
+#===QUANTIZATION===
+#our paramaters are 8 byte floats, but the pixels they work on are whole
+# numbers from 0 to 255 (1 byte each). Quantization stores the weights as 1 byte
+# whole numbers too (int8, from -127 to 127), which makes the model 8 times
+# smaller, and does the multiplying with whole numbers.
+# + every row of a weight matrix (the weights going into one node) gets its own
+# scale: the largest weight in the row becomes 127, and every other weight is
+# rounded to the nearest step of size scale = largest / 127. So each weight is
+# W[j, k] ~ scale[j] * W_q[j, k].
+# + the pixels already are whole numbers (with a scale of 1/255). The nodes of
+# the hidden layers are not, so after ReLU (which makes them all 0 or more)
+# every column is rounded to whole numbers from 0 to 255 with its own scale in
+# the same way, each time predictions are made.
+# + the sums of W_q times the inputs are added up as whole numbers and only
+# then multiplied by both scales and added to the bias', which are kept as
+# floats since there are so few of them.
+#rounding changes the predictions a little, so quantization_report measures how
+# much accuracy we lose.
+
+#the largest whole numbers we store weights and nodes as.
+WEIGHT_LEVELS = 127
+NODE_LEVELS = 255
+
+#quantizes the weights of every layer. Returns [W1_q, scale1, b1, W2_q, ...],
+# where W_q is int8 and the scales (one per row) and bias' are the type of
+# number the model was trained with.
+def quantize_params(params):
+    quantized = []
+    for l in range(len(params)//2):
+        W = np.asarray(params[2*l])
+        b = np.asarray(params[2*l+1])
+
+        #rows of all zeros get a scale of 1 so that we never divide by 0.
+        scale = np.abs(W).max(axis=1) / W.dtype.type(WEIGHT_LEVELS)
+        scale[scale == 0] = 1
+        W_q = np.rint(W / scale[:, None]).astype(np.int8)
+        quantized += [W_q, scale, b.ravel()]
+    return quantized
+
+#the same as quantize_params in reverse, the float weights the quantized model
+# stands for (used to measure the rounding error).
+def dequantize_params(quantized):
+    params = []
+    for l in range(len(quantized)//3):
+        W_q, scale, b = quantized[3*l:3*l+3]
+        params += [W_q * scale[:, None], b[:, None]]
+    return params
+
+#a Predictor (see INFERENCE) for quantized models, with the same predict,
+# predict_proba and top_k methods.
+# + numpy has no fast way to multiply int8 matrices. The fast matrix code it
+# uses (BLAS) only works with floats, and multiplying whole number arrays is
+# about 30 times slower. But floats hold whole numbers exactly, as long as
+# they aren't too large: up to 2^24 for float32 and 2^53 for float64. The
+# largest sum a row can reach is the sum of its |W_q| times 255, so for every
+# layer we use float32 if that is small enough (it almost always is) and
+# float64 otherwise, and the sums come out exactly the same as adding up whole
+# numbers would. The model is still stored (and sent around) as int8.
+class QuantizedPredictor(Predictor):
+
+    #params - float paramaters [W1, b1, ...] to quantize, or already quantized
+    # ones [W1_q, scale1, b1, ...] from quantize_params or load_quantized
+    #chunk_size - number of data points worked on at a time
+    #cache - a PredictionCache to remember predictions in, or None
+    def __init__(self, params, chunk_size=512, cache=None):
+        super().__init__(params, chunk_size, cache)
+
+    def load(self, params):
+        if np.asarray(params[0]).dtype != np.int8:
+            params = quantize_params(params)
+        self.quantized = list(params)
+        L = len(params)//3
+
+        #params is [W1, b1, ...] like Predictor, with W_q as floats that we can
+        # add up exactly (see above).
+        self.params = []
+        self.scales = []
+        for l in range(L):
+            W_q, scale, b = params[3*l:3*l+3]
+            largest = np.abs(W_q, dtype=np.int64).sum(axis=1).max() * NODE_LEVELS
+            exact = np.float32 if largest < 2**24 else np.float64
+            self.params += [W_q.astype(exact), np.asarray(b)[:, None]]
+            self.scales.append(np.asarray(scale)[:, None])
+        self.dtype = self.params[1].dtype
+        self.workspaces = {}
+        self.loaded(self.quantized)
+
+    #work arrays for a chunk of m data points: the whole number inputs of every
+    # layer, the whole number sums, and the float node values.
+    def workspace(self, m):
+        ws = self.workspaces.get(m)
+        if ws is None:
+            sizes = layer_sizes(self.params)
+            exact = [W.dtype for W in self.params[::2]]
+            ws = {"X": [np.empty((n, m), t) for n, t in zip(sizes[:-1], exact)],
+                  "sum": [np.empty((n, m), t) for n, t in zip(sizes[1:], exact)],
+                  "A": [np.empty((n, m), self.dtype) for n in sizes[1:]],
+                  "scale": np.empty((1, m), self.dtype)}
+            self.workspaces[m] = ws
+        return ws
+
+    #the same as Predictor.chunks, with whole number sums.
+    def chunks(self, X):
+        if X.ndim == 1:
+            X = X[:, None]
+        raw = np.issubdtype(X.dtype, np.integer)
+        L = len(self.params)//2
+        m = X.shape[1]
+        for start in range(0, m, self.chunk_size):
+            stop = min(start + self.chunk_size, m)
+            ws = self.workspace(stop - start)
+
+            #the pixels as whole numbers from 0 to 255, with a scale of 1/255.
+            # Scaled (float) input is turned back into pixels first.
+            X_q = ws["X"][0]
+            if raw:
+                np.copyto(X_q, X[:, start:stop], casting="unsafe")
+            else:
+                np.copyto(X_q, np.rint(X[:, start:stop] * SCALE_FACTOR),
+                          casting="unsafe")
+            input_scale = ws["scale"]
+            input_scale.fill(1 / SCALE_FACTOR)
+
+            for l in range(L):
+                total = ws["sum"][l]
+                A = ws["A"][l]
+                np.matmul(self.params[2*l], X_q, out=total)
+
+                #back to floats: sum * weight scale * input scale + b
+                np.multiply(total, self.scales[l], out=A)
+                np.multiply(A, input_scale, out=A)
+                np.add(A, self.params[2*l+1], out=A)
+                if l == L-1:
+                    break
+
+                #ReLU, then rounding every column to whole numbers from 0 to 255.
+                np.maximum(A, 0, out=A)
+                np.max(A, axis=0, keepdims=True, out=input_scale)
+                np.divide(input_scale, NODE_LEVELS, out=input_scale)
+                input_scale[input_scale == 0] = 1
+                np.divide(A, input_scale, out=A)
+                X_q = ws["X"][l+1]
+                np.rint(A, out=A)
+                np.copyto(X_q, A, casting="unsafe")
+            yield start, stop, A
+
+#saves a quantized model (from quantize_params) in our model file format (see
+# MODEL FILES). It can be read with load_quantized, and evaluated or used for
+# predictions like any other model file.
+def save_quantized(path, quantized, metadata=None):
+    arrays = {}
+    for l in range(len(quantized)//3):
+        arrays[f"W{l+1}"] = quantized[3*l]
+        arrays[f"scale{l+1}"] = quantized[3*l+1]
+        arrays[f"b{l+1}"] = quantized[3*l+2]
+    layers = [quantized[0].shape[1]] + [W.shape[0] for W in quantized[::3]]
+    write_arrays(path, arrays, {"layers": layers, "quantized": True,
+                                **(metadata or {})})
+
+#loads a model saved by save_quantized, [W1_q, scale1, b1, W2_q, ...].
+def load_quantized(path, mmap=True):
+    arrays, metadata = read_arrays(path, mmap)
+    quantized = []
+    for l in range(len(metadata["layers"]) - 1):
+        quantized += [arrays[f"W{l+1}"], arrays[f"scale{l+1}"],
+                      arrays[f"b{l+1}"]]
+    return quantized
+
+#whether a model file holds a quantized model.
+def is_quantized(path):
+    return bool(read_arrays(path)[1].get("quantized"))
+
+#a Predictor for any model file, quantized or not. chunk_size and cache are
+# given to the Predictor (see INFERENCE).
+def load_predictor(path, chunk_size=512, cache=None):
+    if is_quantized(path):
+        return QuantizedPredictor(load_quantized(path), chunk_size, cache)
+    return Predictor(load_model(path), chunk_size, cache)
+
+#compares a model with its quantized version on a dataset: the accuracy of
+# both, how much accuracy was lost, how often they predict the same digit, the
+# size of their paramaters, how long predicting the whole dataset takes, and
+# the largest rounding error of any weight.
+def quantization_report(params, X, Y):
+
+    #params - float paramaters [W1, b1, ...]
+    #X - dataset to predict, raw pixels (uint8) or scaled
+    #Y - correct annotations for each column of X
+
+    quantized = quantize_params(params)
+    report = {}
+    predictions_by_model = {}
+    for name, predictor in (("float", Predictor(params)),
+                            ("int8", QuantizedPredictor(quantized))):
+        predictor.predict(X[:, :predictor.chunk_size])
+        start = time.perf_counter()
+        prediction = predictor.predict(X)
+        seconds = time.perf_counter() - start
+        predictions_by_model[name] = prediction
+        report[name] = {"accuracy": float(accuracy(prediction, Y)),
+                        "seconds": seconds}
+    report["float"]["bytes"] = sum(np.asarray(p).nbytes for p in params)
+    report["int8"]["bytes"] = sum(p.nbytes for p in quantized)
+    report["accuracy_delta"] = (report["int8"]["accuracy"]
+                                - report["float"]["accuracy"])
+    report["agreement"] = float(np.mean(predictions_by_model["float"]
+                                        == predictions_by_model["int8"]))
+    report["size_ratio"] = report["float"]["bytes"] / report["int8"]["bytes"]
+
+    #the weights the quantized model stands for, compared with the real ones.
+    rounded = dequantize_params(quantized)
+    report["max_weight_error"] = float(max(
+        np.abs(np.asarray(W) - W_rounded).max()
+        for W, W_rounded in zip(params[::2], rounded[::2])))
+    return report
 
-#our scale factor we use so that the data is digestible by our model and our
-# printing functions
-SCALE_FACTOR = 255
-
-#gathering some data characteristics to create our training and testing array
-WIDTH = X_train.shape[1]
-HEIGHT = X_train.shape[2]
-
-#creating our training and testing arrays. The width and height are the
-# characteristics of the image, and in this case it is a 28x28 pixel image.
-# the .shape[0] value is the number of datapoints there are, in this case it is
-# 6000. finally, our scale factor is applied.
-#this will result in a scaled, reshaped array that contains 6000 data points
-# with 784 values in each (1 value for each 28x28 pixels).
-X_train = X_train.reshape(X_train.shape[0],WIDTH*HEIGHT).T / SCALE_FACTOR
-X_test = X_test.reshape(X_test.shape[0],WIDTH*HEIGHT).T  / SCALE_FACTOR
-
-#training our model
-W1, b1, W2, b2 = train_model(X_train, Y_train, 0.15, 200)
-
-#these functions are necessary to run the function, but they are useful for
-# future reference.
-
-#this function creates a file called "trained_params.pk1" and dumps our data in
-# the file as bytes.
-with open("trained_params.pkl","wb") as dump_file:
-    pickle.dump((W1, b1, W2, b2),dump_file)
-
-#this function reads our file and retrieves the data to be used in our
-# show prediction functions.
-with open("trained_params.pkl","rb") as dump_file:
-    W1, b1, W2, b2=pickle.load(dump_file)
-
-#making predictions using our trained model.
-show_prediction(0,X_test, Y_test, W1, b1, W2, b2)
-show_prediction(1,X_test, Y_test, W1, b1, W2, b2)
-show_prediction(2,X_test, Y_test, W1, b1, W2, b2)
-show_prediction(100,X_test, Y_test, W1, b1, W2, b2)
-show_prediction(200,X_test, Y_test, W1, b1, W2, b2)
-show_prediction(150,X_test, Y_test, W1, b1, W2, b2)
+#===MAIN===
+#this script can be used from the command line, for example:
+#   python neuralnetworks_rs.py train --iterations 200 --alpha 0.15
+#   python neuralnetworks_rs.py evaluate --model trained_params.model
+#   python neuralnetworks_rs.py predict 0 1 2 --show
+#importing it (import neuralnetworks_rs) doesn't run anything, so its
+# functions can be used from other code without training a model first.
+# + run any command with --help to see all of its options.
+
+#the folder with the MNIST files in it (see the DATA section). You can set it
+# with the MNIST_DIR environment variable or the --data option.
+MNIST_DIR = os.environ.get("MNIST_DIR", "mnist")
+
+#the file our trained paramaters are written to and read from.
+MODEL_PATH = "trained_params.model"
+
+#trains a model and saves it.
+def train_command(args):
+
+    #loading in the data we will be using. The training and testing arrays are
+    # already reshaped: every 28x28 pixel image (see WIDTH and HEIGHT) is one
+    # column of 784 values (1 value for each pixel), and there are 60000
+    # columns for the training set. We keep the raw pixel values (whole numbers
+    # from 0 to 255, 1 byte each) and our scale factor is applied on the fly
+    # when the data is used.
+    (X_train, Y_train), (X_test, Y_test) = load_mnist(args.data)
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    #holding out the last images of the training set to check the model on.
+    validation = None
+    if args.validation:
+        (X_train, Y_train), validation = split_validation(X_train, Y_train,
+                                                          args.validation)
+
+    #our optimizer and learning rate schedule (see OPTIMIZERS).
+    if args.optimizer == "adam":
+        optimizer = Adam()
+    elif args.optimizer == "sgd":
+        optimizer = SGD()
+    else:
+        optimizer = SGD(args.momentum, nesterov=args.optimizer == "nesterov")
+    decay = args.iterations - args.warmup
+    schedule = {"constant": None,
+                "step": StepSchedule(max(1, decay//3)),
+                "cosine": CosineSchedule(max(1, decay))}[args.schedule]
+    if args.warmup:
+        schedule = WarmupSchedule(args.warmup, schedule)
+
+    #training our model
+    params = train_model(X_train, Y_train, args.alpha, args.iterations,
+                         batch_size=args.batch_size, dtype=args.dtype,
+                         hidden=tuple(args.hidden), workers=args.workers,
+                         checkpoint_path=args.checkpoint,
+                         checkpoint_every=args.checkpoint_every,
+                         resume_from=args.resume,
+                         callbacks=[MetricsRecorder(args.metrics)]
+                                   if args.metrics else None,
+                         optimizer=optimizer, schedule=schedule,
+                         validation=validation,
+                         validate_every=args.validate_every,
+                         patience=args.patience,
+                         augment=Augmenter() if args.augment else None,
+                         augment_workers=args.augment_workers)
+
+    #this function creates our model file and writes our paramaters to it
+    # (see the MODEL FILES section).
+    save_model(args.output, params)
+    print(f"Model saved to {args.output}")
+
+#prints the accuracy of a saved model on the testing set.
+def evaluate_command(args):
+    (X_train, Y_train), (X_test, Y_test) = load_mnist(args.data)
+    prediction = load_predictor(args.model).predict(X_test)
+    print(f"Test Accuracy: {accuracy(prediction, Y_test):.3%}")
+
+#prints (and with --show, shows) the prediction of a saved model for some of
+# the images in the testing set.
+def predict_command(args):
+    (X_train, Y_train), (X_test, Y_test) = load_mnist(args.data)
+    quantized = is_quantized(args.model)
+    params = load_quantized(args.model) if quantized else load_model(args.model)
+    for index in args.indices:
+        show_prediction(index, X_test, Y_test, *params, show=args.show,
+                        quantized=quantized)
+
+#quantizes a saved model, saves the quantized model and prints how it compares
+# with the original on the testing set.
+def quantize_command(args):
+    (X_train, Y_train), (X_test, Y_test) = load_mnist(args.data)
+    params = load_model(args.model)
+    save_quantized(args.output, quantize_params(params))
+    report = quantization_report(params, X_test, Y_test)
+    for name in ("float", "int8"):
+        print(f"{name:>5}: accuracy {report[name]['accuracy']:.3%}, "
+              f"{report[name]['bytes']:,} bytes, "
+              f"{report[name]['seconds']*1000:.1f} ms for the testing set")
+    print(f"Accuracy change: {report['accuracy_delta']:+.3%} "
+          f"(same prediction for {report['agreement']:.2%} of images)")
+    print(f"Largest weight rounding error: {report['max_weight_error']:.3g}")
+    print(f"Quantized model saved to {args.output}")
+
+#reads the command line and runs the command that was asked for.
+# + argv is the list of command line arguments, which comes from sys.argv when
+# it is not given.
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Train and use a neural network that recognizes "
+                    "handwritten digits.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="train a model and save it")
+    train.add_argument("--iterations", type=int, default=200,
+                       help="iterations (epochs with --batch-size)")
+    train.add_argument("--alpha", type=float, default=0.15,
+                       help="learning rate")
+    train.add_argument("--batch-size", type=int, default=None,
+                       help="mini-batch size (default: full-batch)")
+    train.add_argument("--optimizer", choices=["sgd", "momentum", "nesterov",
+                                               "adam"], default="sgd",
+                       help="how the paramaters are updated")
+    train.add_argument("--momentum", type=float, default=0.9,
+                       help="momentum for the momentum and nesterov optimizers")
+    train.add_argument("--schedule", choices=["constant", "step", "cosine"],
+                       default="constant", help="learning rate schedule")
+    train.add_argument("--warmup", type=int, default=0,
+                       help="iterations to warm the learning rate up over")
+    train.add_argument("--validation", type=int, default=0,
+                       help="training images to hold out as a validation set")
+    train.add_argument("--validate-every", type=int, default=1,
+                       help="iterations between validation checks")
+    train.add_argument("--patience", type=int, default=None,
+                       help="stop after this many checks without improvement")
+    train.add_argument("--augment", action="store_true",
+                       help="shift, rotate and distort the training images")
+    train.add_argument("--augment-workers", type=int, default=2,
+                       help="threads making augmented batches")
+    train.add_argument("--hidden", type=int, nargs="+", default=[10],
+                       help="number of nodes in each hidden layer")
+    train.add_argument("--dtype", choices=["float64", "float32"],
+                       default="float64", help="type of number to train with")
+    train.add_argument("--workers", type=int, default=1,
+                       help="number of processes to train with")
+    train.add_argument("--seed", type=int, default=None,
+                       help="seed for the random number generator")
+    train.add_argument("--checkpoint", default=None,
+                       help="file to write checkpoints to")
+    train.add_argument("--checkpoint-every", type=int, default=None,
+                       help="iterations between checkpoints")
+    train.add_argument("--resume", default=None,
+                       help="checkpoint to carry on training from")
+    train.add_argument("--metrics", default=None,
+                       help="file to write the metrics of every iteration to")
+    train.add_argument("--output", default=MODEL_PATH,
+                       help="file to save the model to")
+    train.set_defaults(run=train_command)
+
+    evaluate = commands.add_parser("evaluate",
+                                   help="print the accuracy on the test set")
+    evaluate.set_defaults(run=evaluate_command)
+
+    predict = commands.add_parser("predict",
+                                  help="predict images from the test set")
+    predict.add_argument("indices", type=int, nargs="*",
+                         default=[0, 1, 2, 100, 200, 150],
+                         help="indices of the test images")
+    predict.add_argument("--show", action="store_true",
+                         help="show each image in a window")
+    predict.set_defaults(run=predict_command)
+
+    quantize = commands.add_parser("quantize",
+                                   help="convert a model to whole numbers")
+    quantize.add_argument("--output", default="trained_params.int8.model",
+                          help="file to save the quantized model to")
+    quantize.set_defaults(run=quantize_command)
+
+    for command in (train, evaluate, predict, quantize):
+        command.add_argument("--data", default=MNIST_DIR,
+                             help="folder with the MNIST files")
+    for command in (evaluate, predict, quantize):
+        command.add_argument("--model", default=MODEL_PATH,
+                             help="model file to use")
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+#only runs when the script itself is run, not when it is imported.
+if __name__ == "__main__":
+    main()
 
 #===NOTES===
 #np.exp(x) returns e^x
@@ -479,7 +2962,7 @@ show_prediction(150,X_test, Y_test, W1, b1, W2, b2)
 # from the mnist dataset. Below I have initialized the train and test data.
 # remove commenting and run the block to see what the data arrays look like.
 
-# (X_train, Y_train), (X_test, Y_test) = mnist.load_data()
+# (X_train, Y_train), (X_test, Y_test) = load_mnist(MNIST_DIR)
 
 #X represents the image of the digit, expressed in an array of pixel values.
 
@@ -490,4 +2973,20 @@ show_prediction(150,X_test, Y_test, W1, b1, W2, b2)
 # print(Y_train)
 
 #Also try out testing individual functions themselves to get a better
-# understanding.
\ No newline at end of file
+# understanding.
+
+#To see how much memory a training step allocates with the original functions
+# compared to the TrainingEngine, remove commenting and run the line below
+# after the data has been loaded.
+
+# benchmark_step_allocations(X_train, Y_train)
+
+#To compare training speed and accuracy between np.float64 and np.float32,
+# remove commenting and run the line below after the data has been loaded.
+
+# compare_precisions(X_train, Y_train, X_test, Y_test)
+
+#To see how long it takes to load the data before training can start, remove
+# commenting and run the line below.
+
+# benchmark_startup(MNIST_DIR)
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""Inference server for neuralnetworks_rs.
+
+Loads a trained model once and answers predictions over HTTP. Requests that
+arrive close together are gathered into micro-batches, so many single-image
+requests become a few matrix multiplies instead of one each. Also includes a
+load generator that reports latency percentiles.
+
+    python server.py serve --model trained_params.model
+    python server.py serve --model trained_params.int8.model
+    python server.py load --requests 5000 --concurrency 64
+    python server.py bench
+"""
+
+#used for extra math components
+import numpy as np
+
+#used to read the command line and write our responses
+import argparse
+import json
+import os
+
+#used to run the server and load generator
+import asyncio
+import time
+
+import neuralnetworks_rs as nn
+
+#number of pixels in one image, every request is one image
+PIXELS = nn.WIDTH * nn.HEIGHT
+
+#the largest request body we accept. A JSON image is at most a few characters
+# per pixel, so anything bigger than this is not an image and we don't wait for
+# (or keep) it.
+MAX_BODY = 8*PIXELS + 1024
+
+#gathers single-image requests into batches and runs one forward pass per
+# batch. The first request of a batch waits at most max_delay seconds for
+# others to join it, and a batch never has more than max_batch images, so a
+# quiet server answers almost straight away and a busy one fills up batches.
+# + the forward pass runs in a separate thread (numpy lets go of python while
+# it multiplies matrices), so the server keeps reading new requests, which make
+# up the next batch, while the current one is worked on.
+class MicroBatcher:
+
+    #predictor - the nn.Predictor to predict with
+    #max_batch - most images in one forward pass
+    #max_delay - most seconds the first image of a batch waits for others
+    def __init__(self, predictor, max_batch=64, max_delay=0.002):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.task = None
+
+        #the batch is copied into the same array every time, one column per
+        # image.
+        self.batch = np.empty((PIXELS, max_batch), np.uint8)
+        self.stats = {"requests": 0, "batches": 0}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    #the probabilities of every digit for one image (784 uint8 pixels).
+    async def predict(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    #waits for a batch of requests. Returns once max_batch requests are waiting
+    # or max_delay seconds after the first one arrived.
+    async def gather(self):
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(pending) < self.max_batch:
+
+            #taking everything that is already waiting without sleeping.
+            if not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(),
+                                                      remaining))
+            except asyncio.TimeoutError:
+                break
+        return pending
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.gather()
+            m = len(pending)
+            for column, (image, future) in enumerate(pending):
+                self.batch[:, column] = image
+
+            try:
+                probs = await loop.run_in_executor(
+                    None, self.predictor.predict_proba, self.batch[:, :m])
+            except Exception as error:
+                for image, future in pending:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            #handing every request its own column. A request whose client went
+            # away has a cancelled future, which we skip.
+            for column, (image, future) in enumerate(pending):
+                if not future.done():
+                    future.set_result(probs[:, column])
+            self.stats["requests"] += m
+            self.stats["batches"] += 1
+
+#reads an image from the body of a request: either 784 raw bytes (one per
+# pixel, 0 to 255) or JSON {"pixels": [...]} with 784 numbers.
+def parse_image(body, content_type):
+    if content_type.startswith("application/json"):
+        pixels = json.loads(body)["pixels"]
+        image = np.asarray(pixels, np.float64)
+        #NaN fails every comparison, so it has to be checked for on its own,
+        # and 12.7 is not a pixel value we could round without guessing.
+        if (image.size != PIXELS or not np.isfinite(image).all()
+                or image.min() < 0 or image.max() > 255
+                or (image != np.round(image)).any()):
+            raise ValueError(f"expected {PIXELS} whole numbers from 0 to 255")
+        return image.astype(np.uint8).ravel()
+    if len(body) != PIXELS:
+        raise ValueError(f"expected {PIXELS} bytes, got {len(body)}")
+    return np.frombuffer(body, np.uint8)
+
+#turns a status and a JSON-able object into an HTTP response.
+def http_response(status, reason, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode() + body
+
+#reads one HTTP request. Returns (method, path, headers, body), or None when
+# the client has closed the connection (even part way through a request).
+# + raises ValueError for a request we can't read: a broken request line,
+# headers longer than the reader's limit, or a Content-Length that is not a
+# number or is bigger than MAX_BODY.
+async def read_request(reader):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    except asyncio.LimitOverrunError:
+        raise ValueError("headers too long")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise ValueError("bad request line")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise ValueError(f"bad Content-Length {length!r}")
+    if int(length) > MAX_BODY:
+        raise ValueError(f"body of {length} bytes is larger than {MAX_BODY}")
+    try:
+        body = await reader.readexactly(int(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return method, path, headers, body
+
+#the HTTP server. It understands:
+# + POST /predict - the body is one image (see parse_image), and the answer is
+# {"digit": ..., "probabilities": [...]}
+# + GET /stats - how many requests and batches have been worked on, and the
+# counters of the prediction cache if there is one
+#connections are kept open between requests (keep-alive), like HTTP/1.1
+# clients expect, so the load generator doesn't reconnect every time.
+class InferenceServer:
+
+    #model - a model file (float or quantized, see nn.load_predictor), or the
+    # trained weights and bias' [W1, b1, W2, b2, ...]
+    #max_batch, max_delay - see MicroBatcher
+    #cache_size - most predictions to remember (see nn.PredictionCache), or 0
+    # to not remember any
+    def __init__(self, model, max_batch=64, max_delay=0.002, cache_size=0):
+        cache = nn.PredictionCache(cache_size) if cache_size else None
+        if isinstance(model, str):
+            predictor = nn.load_predictor(model, chunk_size=max_batch,
+                                          cache=cache)
+        else:
+            predictor = nn.Predictor(model, chunk_size=max_batch, cache=cache)
+        self.batcher = MicroBatcher(predictor, max_batch, max_delay)
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as error:
+                    #we can't tell where the next request would start, so
+                    # after answering this one the connection is closed.
+                    writer.write(http_response(400, "Bad Request",
+                                               {"error": str(error)},
+                                               keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(await self.respond(method, path, headers, body,
+                                                keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, path, headers, body, keep_alive):
+        if method == "GET" and path == "/stats":
+            stats = dict(self.batcher.stats)
+            cache = self.batcher.predictor.cache
+            if cache is not None:
+                stats["cache"] = cache.stats()
+            return http_response(200, "OK", stats, keep_alive)
+        if path != "/predict":
+            return http_response(404, "Not Found", {"error": "not found"},
+                                 keep_alive)
+        if method != "POST":
+            return http_response(405, "Method Not Allowed",
+                                 {"error": "use POST"}, keep_alive)
+        try:
+            image = parse_image(body, headers.get("content-type", ""))
+        except (ValueError, KeyError, TypeError) as error:
+            return http_response(400, "Bad Request", {"error": str(error)},
+                                 keep_alive)
+        probs = await self.batcher.predict(image)
+        return http_response(200, "OK",
+                             {"digit": int(np.argmax(probs)),
+                              "probabilities": probs.tolist()}, keep_alive)
+
+#the latency percentiles (in milliseconds) and requests per second of a list
+# of request latencies in seconds.
+def latency_report(latencies, seconds):
+    ms = np.asarray(latencies) * 1000
+    return {"requests": len(latencies),
+            "requests_per_second": len(latencies) / seconds,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p90_ms": float(np.percentile(ms, 90)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "max_ms": float(ms.max())}
+
+#sends requests images to the server from concurrency connections at once,
+# each sending its next request as soon as it gets an answer, and reports the
+# latencies (see latency_report).
+# + images is (784, n) uint8, and the requests go through them in order.
+async def load_test(host, port, images, requests=2000, concurrency=32):
+    latencies = []
+    counter = iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in counter:
+                body = images[:, i % images.shape[1]].tobytes()
+                start = time.perf_counter()
+                writer.write(f"POST /predict HTTP/1.1\r\nHost: {host}\r\n"
+                             f"Content-Type: application/octet-stream\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode()
+                             + body)
+                await writer.drain()
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latency_report(latencies, time.perf_counter() - start)
+
+#the images to send: the MNIST test set if it can be found, otherwise random
+# pixels (which are just as much work for the model).
+def load_images(directory):
+    try:
+        (_, _), (X_test, _) = nn.load_mnist(directory)
+        return np.ascontiguousarray(X_test[:, :10000])
+    except FileNotFoundError:
+        rng = np.random.default_rng(0)
+        return rng.integers(0, 256, (PIXELS, 1000), dtype=np.uint8)
+
+def serve_command(args):
+    async def serve():
+        server = InferenceServer(args.model, args.max_batch, args.max_delay_ms/1000,
+                                 args.cache_size)
+        host, port = await server.start(args.host, args.port)
+        print(f"Serving {args.model} on http://{host}:{port}")
+        await server.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+def load_command(args):
+    images = load_images(args.data)
+    report = asyncio.run(load_test(args.host, args.port, images,
+                                   args.requests, args.concurrency))
+    print(json.dumps(report, indent=2))
+
+#starts a server in this process for each max batch size in turn and runs the
+# load generator against it, so the effect of micro-batching can be compared.
+# Uses the model file if it exists, otherwise a freshly initialized model.
+def bench_command(args):
+    if os.path.exists(args.model):
+        model = args.model
+    else:
+        np.random.seed(0)
+        model = nn.initial_layers([PIXELS, 10, 10])
+    images = load_images(args.data)
+
+    async def bench(max_batch):
+        server = InferenceServer(model, max_batch, args.max_delay_ms/1000,
+                                 args.cache_size)
+        host, port = await server.start("127.0.0.1", 0)
+        try:
+            report = await load_test(host, port, images, args.requests,
+                                     args.concurrency)
+        finally:
+            await server.stop()
+        stats = server.batcher.stats
+        report["mean_batch"] = stats["requests"] / max(1, stats["batches"])
+        if server.batcher.predictor.cache is not None:
+            report["cache"] = server.batcher.predictor.cache.stats()
+        return report
+
+    results = {}
+    print(f"{'max batch':>9} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'mean batch':>10}")
+    for max_batch in args.max_batches:
+        report = results[max_batch] = asyncio.run(bench(max_batch))
+        print(f"{max_batch:>9} {report['requests_per_second']:>9,.0f} "
+              f"{report['p50_ms']:>8.2f} {report['p90_ms']:>8.2f} "
+              f"{report['p99_ms']:>8.2f} {report['mean_batch']:>10.1f}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="answer predictions over HTTP")
+    serve.set_defaults(run=serve_command)
+    load = commands.add_parser("load", help="send requests to a server")
+    load.set_defaults(run=load_command)
+    bench = commands.add_parser("bench", help="compare micro-batch sizes")
+    bench.add_argument("--max-batches", type=int, nargs="+",
+                       default=[1, 16, 64])
+    bench.add_argument("--output", default=None,
+                       help="file to write the JSON results to")
+    bench.set_defaults(run=bench_command)
+
+    for command in (serve, load):
+        command.add_argument("--host", default="127.0.0.1")
+        command.add_argument("--port", type=int, default=8000)
+    for command in (serve, bench):
+        command.add_argument("--model", default=nn.MODEL_PATH,
+                             help="model file to serve")
+        command.add_argument("--max-delay-ms", type=float, default=2.0,
+                             help="most time a request waits for a batch")
+        command.add_argument("--cache-size", type=int, default=0,
+                             help="most predictions to remember (0 for none)")
+    serve.add_argument("--max-batch", type=int, default=64,
+                       help="most images in one forward pass")
+    for command in (load, bench):
+        command.add_argument("--data", default=nn.MNIST_DIR,
+                             help="folder with the MNIST files")
+        command.add_argument("--requests", type=int, default=5000)
+        command.add_argument("--concurrency", type=int, default=64,
+                             help="connections sending requests at once")
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()